@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+# This script benchmarks the processing stages of the digital meter on the recorded telegrams in ./telegrams
+# use: python bench.py [number of runs per stage], compare the output of a Pi Zero with a Pi 4 to find the slow stage.
+
+import asyncio
+import datetime
+import io
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.console import Console
+from rich.table import Table
+
+from src import pi
+from src.app.logger import Logger
+from src.app.metrics import Metrics
+from src.app.pickleit import PickleIt
+from src.app.net_id import NetId
+from src.dm_app.screen_meter import ScreenMeter
+from src.dm_app.screens import ScreenSnapshot
+from src.dm_app.bus_meter import InputChunkProtocol, crc16, crc16_backends
+from src.dm_app.telegram import TelegramBuffer
+from src.dm_app.series import TimeSeries
+from src.config import obiscodes, dir_telegrams
+
+# the class_id branches of the parser
+class_groups = {"1/10": [1, 10], "3/5/21/71": [3, 5, 21, 71], "4": [4], "7": [7], "8": [8], "70": [70], "72": [72]}
+
+
+def bench_env():
+    """ run in a temporary directory with the rates and the telegrams, so pickle, log and history files stay untouched """
+    tmp_dir = tempfile.mkdtemp()
+    shutil.copy("rates.json", tmp_dir)
+    shutil.copytree(dir_telegrams, os.path.join(tmp_dir, dir_telegrams))
+    os.chdir(tmp_dir)
+    pi.console = Console()
+    pi.log_app = Logger(pi.console, Console(file=io.StringIO()))
+    pi.disk_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk_io")
+    pi.metrics = Metrics()
+    pi.pickle_app = PickleIt(pi.log_app, pi.disk_io, pi.metrics)
+    pi.net_id = NetId(pi.log_app)
+    pi.socket_app = None
+    pi.log_app.log_start("Starting benchmark")
+    return tmp_dir
+
+
+def time_it(fn, items):
+    """ return the list of nanoseconds fn took for each of the items """
+    ns = []
+    for it in items:
+        start = time.perf_counter_ns()
+        fn(it)
+        ns.append(time.perf_counter_ns() - start)
+    return ns
+
+
+def new_meter(parser="compiled"):
+    meter = ScreenMeter(None, {"parser": parser})
+    meter.set_data()
+    meter.set_pointers()
+    return meter
+
+
+def bench_stages(runs):
+    """ return list of (stage, what is timed, nanoseconds per run) """
+    fixtures = dict((file_n, open(f"{dir_telegrams}{file_n}", "rb").read()) for file_n in sorted(os.listdir(dir_telegrams)))
+    raw = [list(fixtures.values())[x % len(fixtures)] for x in range(runs)]
+    results = []
+    # 1. framing, fed in chunks of 1024 bytes as the serial port does
+    protocol = InputChunkProtocol(asyncio.Queue())
+    chunked = [[it[x:x+1024] for x in range(0, len(it), 1024)] for it in raw]
+
+    def framing(chunks):
+        for chunk in chunks:
+            protocol.data_received(chunk)
+        protocol.telegrams.get_nowait()
+    results.append(("framing", "InputChunkProtocol.data_received", time_it(framing, chunked)))
+    # 2. checksum
+    meter = new_meter()
+    telegrams = [TelegramBuffer(crc16).feed(it)[0] for it in raw]
+    results.append(("checkcrc", "BusMeter.checkcrc", time_it(meter.checkcrc, telegrams)))
+    for name, crc in crc16_backends().items():
+        results.append((f"crc16 {name}", "crc.new(telegram)", time_it(crc.new, raw)))
+    # 3. parsing of the full telegram by both parser engines, then per class_id branch and per line
+    for parser in ["compiled", "regex"]:
+        meter = new_meter(parser)
+        results.append((f"parse {parser}", "BusMeter.parse_telegram", time_it(meter.parse_telegram, telegrams)))
+    # the compiled parser only decodes the lines that changed, most lines do not change from second to second
+    meter = new_meter()
+    results.append(("parse compiled same", "BusMeter.parse_telegram", time_it(meter.parse_telegram, telegrams[:1] * runs)))
+    lines = [bytes(line) for it in fixtures.values() for line in TelegramBuffer(crc16).feed(it)[0] if line]
+    meter = new_meter()
+    meter.parse_telegram(telegrams[0])  # the phase check needs the grid config
+    for group, class_ids in class_groups.items():
+        group_lines = [x for x in lines if (x.partition(b"(")[0].decode() in obiscodes and
+                                            obiscodes[x.partition(b"(")[0].decode()].class_id in class_ids)]
+        group_lines = [group_lines[x % len(group_lines)] for x in range(runs)]
+        results.append((f"line class {group}", "ObisParser.parse_line",
+                        time_it(meter.parse_line, group_lines)))
+        results.append((f"line class {group}", "BusMeter.parsetelegramline",
+                        time_it(meter.parsetelegramline, [x.decode() for x in group_lines])))
+    # 4. usage, every run is a second later with some consumption
+    meter = new_meter()
+    meter.parse_telegram(telegrams[1])
+    start_time = meter.cur_time
+
+    def usage(x):
+        meter.cur_time = start_time + datetime.timedelta(seconds=x)
+        meter.kwH_day_plus += 0.0005
+        meter.update_usage()
+    results.append(("usage", "Usage.update_usage", time_it(usage, range(runs))))
+    cumuls = [(meter.data["cumul"], [x + 0.001 for x in meter.data["cumul"]])] * runs
+    results.append(("usage delta", "Usage.get_delta_cumul", time_it(lambda x: meter.get_delta_cumul(*x), cumuls)))
+    series = TimeSeries()
+
+    def series_add(x):
+        meter.cur_time = start_time + datetime.timedelta(seconds=x)
+        series.add(meter)
+    results.append(("series", "TimeSeries.add", time_it(series_add, range(runs))))
+    # 5. the snapshot is all the event loop does for the screen, the renderer thread builds the layout and renders it
+    meter.layout = meter.make_layout()
+    meter.p1_table = meter.parse_telegram(telegrams[1])
+    results.append(("snapshot", "ScreenSnapshot", time_it(lambda x: ScreenSnapshot(meter, {}), range(runs))))
+    snapshot = ScreenSnapshot(meter, {})
+
+    def layout_all(layout):
+        snapshot.panel_keys = {}
+        snapshot.update_layout(layout)
+    results.append(("layout all panels", "Panels.update_layout", time_it(layout_all, [meter.layout] * runs)))
+    # only the panels of which the data changed are built again
+    results.append(("layout unchanged", "Panels.update_layout", time_it(snapshot.update_layout, [meter.layout] * runs)))
+    console = Console(file=io.StringIO(), width=180, height=54, force_terminal=True)
+    results.append(("render", "Console.print(layout)", time_it(console.print, [meter.layout] * runs)))
+    # 6. the metrics are always on, what they add to each timed stage
+    def metrics(x):
+        with pi.metrics.parse.time():
+            pi.metrics.telegrams.inc()
+    results.append(("metrics", "Histogram.time + Counter.inc", time_it(metrics, range(runs))))
+    return results
+
+
+def bench_table(results, runs):
+    table = Table(title=f"Digital meter benchmark - {platform.node()} {platform.machine()} "
+                        f"python {platform.python_version()} - {runs} runs per stage")
+    table.add_column("Stage", style="cyan", no_wrap=True)
+    table.add_column("Timed", style="magenta", no_wrap=True)
+    for col in ["per s", "mean µs", "p50 µs", "p95 µs", "max µs"]:
+        table.add_column(col, justify="right", style="green")
+    for stage, timed, ns in results:
+        us = sorted(x / 1000 for x in ns)
+        table.add_row(stage, timed, f"{1e6 / statistics.mean(us):.0f}", f"{statistics.mean(us):.1f}",
+                      f"{us[len(us) // 2]:.1f}", f"{us[int(len(us) * 0.95)]:.1f}", f"{us[-1]:.1f}")
+    return table
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    tmp_dir = bench_env()
+    try:
+        pi.console.print(bench_table(bench_stages(runs), runs))
+    finally:
+        pi.disk_io.shutdown(wait=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
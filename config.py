@@ -5,13 +5,37 @@
 # Change your serial port here:
 serial_port = '/dev/ttyUSB0'
 
+meter_info = {
+    "parser": "compiled",              # telegram parser: "compiled" (table driven, fast) or "regex" (original)
+    "replay": "",                      # file (pattern) with recorded telegrams (raw or .gz) to read instead of serial_port
+    "replay_speed": 0,                 # replay speed up versus 1 telegram per second, 0 = as fast as possible
+    "capture": False,                  # keep the raw telegrams in ./history/YYYY-MM-DD_telegrams.p1.gz
+    "capture_batch": 60,               # seconds of telegrams written to the archive at once
+    "capture_days": 31,                # days of telegram archives kept
+    "series": False,                   # keep the readings of every second in ./history/series, see series_tiers in src/config.py
+    "series_batch": 60,                # seconds of readings written to the time series at once
+    "history_db": False,               # keep the readings and the usage of the ended periods in ./history/history.db
+    "history_batch": 60,               # seconds of readings inserted in the history database at once
+    "history_days": 7,                 # days of readings kept in the history database, the usage is kept forever
+    "json_s": 60,                      # seconds between the exports of data.json to ./history, always at the end of the day
+    "json_indent": None,               # indent of data.json, None is compact
+    "headless": False,                 # no screens and no tmux sessions, e.g. when run as a systemd service
+    "fps": 1,                          # screen refreshes per second at most, the screen is only refreshed when it changed
+}
+
 socket_info = {
     # make this empty if you don't have a remote socket server to connect to
     "remote_ips":  ["192.168.15.130", "192.168.15.65", "192.168.40.10"],  # hosts able to give instructions to the meter
     "server_port": 8081,               # port for the digital meter server
     "ws_ip": "192.168.15.65",          # destination ip for meter data
     "dest_port": 8081,                 # destination port for meter data and notifications
-    "update_freq": 30,                 # update frequency in seconds
+    "update_freq": 30,                 # update frequency in seconds, only the things that changed are sent
+    "full_refresh": 300,               # seconds between the updates with all the things
+    "deadbands": {                     # a thing changed when it differs more than this, default any change
+        "electricity_mains^fluvius_night^sensor": 0.05,  # kW
+        "electricity_mains^fluvius_day^sensor": 0.05},   # kW
+    "sub_ips": [],                     # local consumers able to subscribe to /sub, besides the remote_ips
+    "sub_depth": 256,                  # updates kept for the subscribers, a slower subscriber loses the oldest
     "ws_url": "ws://{ip}:{port}/ws"}   # websocket url
 
 
@@ -3,15 +3,38 @@
 # This script will read and process data from serial P1 port of the digital meter as used in Belgium.
 # https://github.com/rudyvan/digital_meter
 
+import os
+import shutil
+import sys
+
 import rich
 
-from config import serial_port, socket_info, ths_map
+from config import serial_port, meter_info, socket_info, ths_map
 
 from src import BusMeter, pi
+from src.config import dir_replay
 
 rich.traceback.install(width=180, extra_lines=10, show_locals=True)
 
-pi.install(socket_info)
+# python dm.py replay <file or pattern> [speed] feeds recorded telegrams instead of the serial port
+if len(sys.argv) > 2 and sys.argv[1] == "replay":
+    meter_info |= {"replay": sys.argv[2], "replay_speed": float(sys.argv[3]) if len(sys.argv) > 3 else 0}
+if meter_info.get("replay"):
+    # a replay starts from scratch in its own directory, with its own pickle, journal, log and history files,
+    # and does not send the replayed values to the socket server as if they were live
+    meter_info["replay"] = os.path.abspath(meter_info["replay"])
+    shutil.rmtree(dir_replay, ignore_errors=True)
+    os.makedirs(dir_replay)
+    shutil.copy("rates.json", dir_replay)
+    os.chdir(dir_replay)
+    socket_info = {}
+
+pi.install(socket_info, meter_info.get("headless", False))
 
 if __name__ == '__main__':
-    BusMeter(serial_port).run(ths_map)
\ No newline at end of file
+    if meter_info.get("headless", False):
+        BusMeter(serial_port, meter_info).run(ths_map)
+    else:
+        # the screens are only imported when they are shown
+        from src.dm_app.screen_meter import ScreenMeter
+        ScreenMeter(serial_port, meter_info).run(ths_map)
\ No newline at end of file
@@ -23,6 +23,7 @@ from ..config import dir_history, log_name, log_file
 class Logger:
     def __init__(self, console, log_console, *args, **kwargs):
         self.console, self.log_console = console, log_console
+        self.prefix_day, self.prefix = None, None  # prefix_history of that day
         if not os.path.exists(dir_history):
             os.makedirs(dir_history)
         super().__init__(*args, **kwargs)
@@ -36,9 +37,11 @@ class Logger:
 
     @property
     def prefix_history(self):
-        # take yesterday date and format it to MM-DD
-        mm_dd = (datetime.date.today()-datetime.timedelta(days=1)).isoformat()[5:]
-        return f"{dir_history}{mm_dd}_"
+        # take yesterday date and format it to MM-DD, once a day
+        if (today := datetime.date.today()) != self.prefix_day:
+            mm_dd = (today-datetime.timedelta(days=1)).isoformat()[5:]
+            self.prefix_day, self.prefix = today, f"{dir_history}{mm_dd}_"
+        return self.prefix
 
     def clear_handlers(self, logger):
         while logger.handlers:
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# encoding=utf-8
+"""contains the metrics of the meter process, shown in the prometheus text format on /metrics of the socket server
+
+counters and histograms are plain numbers updated in place, cheap enough to be always on,
+the histograms are updated from the event loop, the renderer and the disk_io thread, hence their lock
+"""
+import bisect
+import threading
+import time
+
+# seconds, from 50µs (a parsed line) up to 5s (a stalled event loop)
+buckets_s = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name, self.help, self.value = name, help, 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def lines(self):
+        return [f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Gauge:
+    """ the value is asked to fn when the metrics are shown, a dict is one value per label """
+    def __init__(self, name, help, fn, label=""):
+        self.name, self.help, self.fn, self.label = name, help, fn, label
+
+    def lines(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            return [f"# TYPE {self.name} gauge"] + [f'{self.name}{{{self.label}="{k}"}} {v}' for k, v in value.items()]
+        return [f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Timer:
+    """ with histogram.time(): ... observes the seconds spent in the with block """
+    __slots__ = ["histogram", "start"]
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=buckets_s):
+        self.name, self.help, self.buckets = name, help, buckets
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, the last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def lines(self):
+        with self.lock:
+            counts, total = self.counts[:], self.sum
+        lines, cumul = [f"# TYPE {self.name} histogram"], 0
+        for le, count in zip([str(x) for x in self.buckets] + ["+Inf"], counts):
+            cumul += count
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumul}')
+        return lines + [f"{self.name}_sum {total}", f"{self.name}_count {cumul}"]
+
+
+class Metrics:
+    """ the metrics of the meter process, one attribute per metric """
+
+    def __init__(self):
+        self.registry = []
+        self.telegrams = self.add(Counter("dm_telegrams_total", "Telegrams received"))
+        self.crc_failures = self.add(Counter("dm_crc_failures_total", "Telegrams with a missing or wrong CRC16"))
+        self.parse = self.add(Histogram("dm_parse_seconds", "Parsing of a telegram"))
+        self.update_usage = self.add(Histogram("dm_update_usage_seconds", "Update of the usage after a telegram"))
+        self.update_layout = self.add(Histogram("dm_update_layout_seconds", "Update of the screen panels"))
+        self.pickle_save = self.add(Histogram("dm_pickle_save_seconds", "Write of the pickle file by disk_io"))
+        self.ws_send = self.add(Histogram("dm_websocket_send_seconds", "Send of a message to a websocket host"))
+        self.ws_drops = self.add(Counter("dm_websocket_queue_drops_total", "Messages dropped, websocket queue full"))
+        self.loop_lag = self.add(Histogram("dm_event_loop_lag_seconds", "Delay of the event loop on a timer"))
+
+    def add(self, metric):
+        self.registry.append(metric)
+        return metric
+
+    def text(self):
+        """ return all metrics in the prometheus text format """
+        return "".join(f"# HELP {x.name} {x.help}\n" + "\n".join(x.lines()) + "\n" for x in self.registry)
@@ -3,28 +3,50 @@
 import aiohttp, asyncio
 from aiohttp import web
 import websockets
-import socket
 import json
 import datetime
 
+from .wire import Wire
+from .stream import Stream
+from .metrics import Gauge
+from ..config import obiscodes
+
 app = web.Application()
 
+# the things of the phases topic of /sub and the OBIS codes of their lines
+phases = ["kW_plus", "kW_min", "L1_plus", "L2_plus", "L3_plus", "L1_min", "L2_min", "L3_min",
+          "V_L1", "V_L2", "V_L3", "A_L1", "A_L2", "A_L3"]
+phases_obis = set(obis for obis, obis_guide in obiscodes.items() if obis_guide.th_n in phases)
+
 class SocketApp:
     """aiohttp web application"""
-    def __init__(self, socket_info, log_app, *args, **kwargs):
+    def __init__(self, socket_info, log_app, net_id, metrics, *args, **kwargs):
         self.socket_info = socket_info
         self.log_app = log_app
+        self.net_id = net_id
+        self.metrics = metrics
+        self._last_sent = {}  # th -> value last sent by send_ths
+        self.wires = {}  # ip -> wire format negotiated by that host, json if not
+        self.stream = Stream(log_app, self.json_default, (socket_info or {}).get("sub_depth", 256))
+        metrics.add(Gauge("dm_websocket_queue_depth", "Messages waiting in the websocket queue", lambda: dict(
+            (ip, queue.qsize()) for ip, queue in getattr(self, "_send_queues", {}).items()), "ip"))
+        metrics.add(Gauge("dm_subscribers", "Subscribers per topic of /sub", lambda: dict(self.stream.subscribed), "topic"))
         super().__init__(*args, **kwargs)
 
-    def json_it(self, dct):
-        """ dump the data in json format"""
-        encode_JSON = lambda x: self.DM_selfie.ts_str(x) if isinstance(x, datetime.datetime) else repr(x)
-        return json.dumps(dct, indent=4, sort_keys=True, default=encode_JSON)
+    def json_default(self, x):
+        """ encode what json does not know, a datetime as the meter shows it """
+        return self.DM_selfie.ts_str(x) if isinstance(x, datetime.datetime) else repr(x)
+
+    @property
+    def wire(self):
+        if not hasattr(self, "_wire"):
+            self._wire = Wire(self.DM_selfie.ths_map, self.json_default)
+        return self._wire
 
     async def send_ws(self, data, ip):
         """ run a task pushing data from queue to the destination websocket server
             A queue is used as not to slow down the caller
-            the data is dropped if the queue is full """
+            the data is dropped if the queue is full, return True when the data is queued """
         if not hasattr(self, "_send_tasks"):
             self._send_tasks = {}
             self._send_queues = {}
@@ -32,31 +54,41 @@ class SocketApp:
         if ip not in self._send_tasks or self._send_tasks[ip].done():
             self._send_queues[ip] = asyncio.Queue(maxsize=15)
             self._send_tasks[ip] = asyncio.create_task(self.task_send_ws(ip))
-        # 2. add data to the queue
-        data_str = data if isinstance(data, str) else self.json_it(data)
-        self.log_app.add(f"Websocket Queue {ip}: {len(data_str)} bytes added", tpe="debug")
+        # 2. add data to the queue, it is encoded in the wire format of the host when sent
         if self._send_queues[ip].full():
-            return self.log_app.add(f"Websocket Queue {ip} full", tpe="error")
-        # could add test for not sending repeat data
-        await self._send_queues[ip].put(data_str)
+            self.metrics.ws_drops.inc()
+            self.log_app.add(f"Websocket Queue {ip} full", tpe="error")
+            return False
+        await self._send_queues[ip].put(data)
+        return True
 
     async def task_send_ws(self, ip):
-        """ perpetual task trying to send data from a queue to a host socket server,
-            The connection is closed automatically after each iteration of the loop.
+        """ perpetual task keeping one websocket connection to a host socket server and sending the data from its queue,
+            what is in the queue is taken at once and sent over the same connection, one message per data.
+            If the connection closes, the data not sent yet is kept and sent first after the reconnection.
             If an error occurs while establishing the connection, connect() retries with exponential backoff.
             The backoff delay starts at three seconds and increases up to one minute.
-            If an error occurs in the body of the loop, you can handle the exception and connect() will reconnect with
-            the next iteration; or you can let the exception bubble up and break out of the loop.
-            This lets you decide which errors trigger a reconnection and which errors are fatal.
             """
         end_p = self.socket_info["ws_url"].format(ip=ip, port=self.socket_info["dest_port"])
+        queue, pending = self._send_queues[ip], []
         async for websocket in websockets.connect(end_p, compression=None):
             try:
-                data = await self._send_queues[ip].get()
-                data_str = json.dumps(json.loads(data))  # remove newlines and tabs
-                self.log_app.add(f"Websocket Send to {end_p} --> {data_str}", tpe="debug")
-                await websocket.send(data)
-            except websockets.ConnectionClosed:
+                while True:
+                    if not pending:
+                        pending.append(await queue.get())
+                        while not queue.empty():
+                            pending.append(queue.get_nowait())
+                    self.log_app.add(f"Websocket Send to {end_p} --> {len(pending)} messages", tpe="debug")
+                    while pending:
+                        # the wire format negotiated by the host at the time of sending, json if none
+                        payload = pending[0] if isinstance(pending[0], (str, bytes)) else \
+                            self.wire.encode(pending[0], self.wires.get(ip, "json"))
+                        self.log_app.add(f"Websocket Send to {end_p}: {len(payload)} bytes", tpe="debug")
+                        with self.metrics.ws_send.time():
+                            await websocket.send(payload)
+                        pending.pop(0)
+            except websockets.ConnectionClosed as e:
+                self.log_app.add(f"Websocket {end_p} closed, {len(pending)} messages kept {e}", tpe="debug")
                 continue
 
     def my_assert(self, c, m):
@@ -69,8 +101,8 @@ class SocketApp:
     get_val = lambda self, val: val.get("value", 0) * 1000 if isinstance(val, dict) else val
     get_val_th = lambda self, th: 0.0 if not hasattr(self.DM_selfie, th) else self.get_val(getattr(self.DM_selfie, th))
 
-    async def reply_ws(self, data, ip, ws):
-        """ reply to a websocket server request
+    async def reply_ws(self, data_dct, ip, ws):
+        """ reply to a websocket server request, the message decoded from its wire format
             below code is propriety and should be adapted to your specific needs in communicating obdis values to
             external websocket servers
         """
@@ -79,9 +111,14 @@ class SocketApp:
             data_dct["cmd"] = "reply"
             return await self.send_ws(data_dct, ip)
         ths_map = self.DM_selfie.ths_map
-        self.log_app.add(f"Websocket Server: rcv from {ip}: {data}", tpe="debug")
+        self.log_app.add(f"Websocket Server: rcv from {ip}: {data_dct}", tpe="debug")
         all_keys = ["type", "cmd", "th", "val"]
-        data_dct = json.loads(data)
+        # a host asking for a compact wire format gets the format chosen and the schema of the messages, in json
+        if data_dct.get("type", None) == "hello":
+            self.wires[ip] = self.wire.negotiate(data_dct.get("wire", []))
+            self.log_app.add(f"Websocket {ip} wire format {self.wires[ip]}")
+            return await ws.send_str(self.wire.encode({"type": "hello", "wire": self.wires[ip], "schema": self.wire.schema}))
+        data = data_dct.get("th", "")
         # intercept special cases of domestic_water^purchased_water, as the digital_meter does not registrate water from
         # pidpa, with own water meter registering consumption, pidpa consumption is derived
         # other case gas^purchased_gas^cooking and heating is similar, see PI-Energy for more information
@@ -118,23 +155,37 @@ class SocketApp:
                 data_dct["val"] = self.get_val_th(obdis_th)
                 return await self.send_ws(data_dct, ip)
             case "cum" | "usage":  # ask for a cum or usage
-                self.log_app.add(f"Things_sync ignored Forensics request: {data}", tpe="debug")
+                self.log_app.add(f"Things_sync ignored Forensics request: {data_dct}", tpe="debug")
             case _:
                 return
 
     async def send_ths(self):
-        """ every config.socket_info[update_freq] seconds send the digital meter things to the remote server
-            by filling the queue.
+        """ every config.socket_info[update_freq] seconds send the digital meter things that changed to the remote
+            server by filling the queue, all changes in one message, a thing changed when it differs more than its
+            deadband (socket_info[deadbands], default any change) from the value last sent,
+            every socket_info[full_refresh] seconds all things are sent.
             below code is propriety and should be adapted to your specific needs in communicating obdis values to
             external websocket servers
         """
         now = datetime.datetime.now()
-        if not hasattr(self, "_last_send") or (now - self._last_send).total_seconds() > self.socket_info["update_freq"]:
-            ths_map = self.DM_selfie.ths_map
-            data_dct = [{"type": "th", "cmd": "set", "th": th, "val": self.get_val(getattr(self.DM_selfie, th_attr, 0.0))}
-                        for th, th_attr in ths_map.items() if th_attr]
-            await self.send_ws(data_dct, self.socket_info["ws_ip"])
-            self._last_send = now
+        if hasattr(self, "_last_send") and (now - self._last_send).total_seconds() <= self.socket_info["update_freq"]:
+            return
+        self._last_send = now
+        if full := not hasattr(self, "_last_full") or \
+                (now - self._last_full).total_seconds() > self.socket_info.get("full_refresh", 300):
+            self._last_full = now
+        deadbands, data_dct, sent = self.socket_info.get("deadbands", {}), [], {}
+        for th, th_attr in self.DM_selfie.ths_map.items():
+            if not th_attr:
+                continue
+            val, last = self.get_val(getattr(self.DM_selfie, th_attr, 0.0)), self._last_sent.get(th, None)
+            if full or last is None or (abs(val - last) > deadbands.get(th, 0) if isinstance(val, (int, float)) and
+                                        isinstance(last, (int, float)) else val != last):
+                data_dct.append({"type": "th", "cmd": "set", "th": th, "val": val})
+                sent[th] = val
+        # the values only count as sent when queued, a change dropped by a full queue is sent again the next time
+        if data_dct and await self.send_ws(data_dct, self.socket_info["ws_ip"]):
+            self._last_sent.update(sent)
 
     async def request_th(self, th):
         """ ask for the things value
@@ -143,14 +194,24 @@ class SocketApp:
         """
         await self.send_ws({"type": "th", "cmd": "ask", "th": th, "val": 0.0}, self.socket_info["ws_ip"])
 
+    def publish(self, DM_selfie, updated):
+        """ stream the telegram of every valid telegram, the phases when one of their lines changed (changed_obis of
+            the parser), and when the usage was updated also the quarter peak forecast and the usage, to the
+            subscribers, the data is only made when the topic has subscribers """
+        ts = DM_selfie.cur_time
+        self.stream.publish("telegram", lambda: {"ts": ts, "telegram": bytes(DM_selfie.p1telegram).decode(errors="replace")})
+        if DM_selfie.changed_obis & phases_obis:
+            self.stream.publish("phases", lambda: dict([("ts", ts)] + [(x, getattr(DM_selfie, x, None)) for x in phases]))
+        if not updated:
+            return
+        self.stream.publish("peak", lambda: {"ts": ts, "quarter_peak": DM_selfie.quarter_peak,
+                                             "peak_forecast": DM_selfie.peak_forecast, "peak_gap": DM_selfie.peak_gap,
+                                             "month_peak": DM_selfie.month_peak["value"]})
+        self.stream.publish("usage", lambda: {"ts": ts, "usage": DM_selfie.usage})
+
     @property
     def my_ip(self):  # return my ip address
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sc:
-                sc.connect(("8.8.8.8", 80))
-                return sc.getsockname()[0]
-        except Exception:
-            return ""
+        return self.net_id.my_ip
 
 
     async def server_start(self, DM_selfie):
@@ -158,13 +219,30 @@ class SocketApp:
         self.DM_selfie = DM_selfie
         if not self.socket_info or not all(self.socket_info.get(k, False) for k in ["server_port", "remote_ips"]):
             return self.log_app.add("Web socket server not started, ?server port, ?remote ips in socket_info", tpe="error")
-        app.add_routes([web.get('/ws', self.websocket_handler)])
+        app.add_routes([web.get('/ws', self.websocket_handler), web.get('/sub', self.subscribe_handler),
+                        web.get('/metrics', self.metrics_handler)])
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, host=self.my_ip, port=self.socket_info["server_port"])
         await site.start()
+        self.lag_task = asyncio.create_task(self.task_loop_lag())
         await self.request_th("domestic_water^purchased_water")
 
+    async def task_loop_lag(self, interval=0.5):
+        """ perpetual task measuring how late the event loop wakes up from a sleep, a stall of the loop shows here """
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.metrics.loop_lag.observe(loop.time() - start - interval)
+
+    async def metrics_handler(self, request):
+        """aiohttp handler of /metrics, the metrics in the prometheus text format"""
+        if request.remote not in self.socket_info.get("remote_ips", []) + self.socket_info.get("sub_ips", []):
+            self.log_app.add(f"rejected metrics {request.remote=}", tpe="error")
+            return web.Response(text=f"<p>NOK - rejected</p>", status=400)
+        return web.Response(body=self.metrics.text().encode(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
     async def websocket_handler(self, request):
         """aiohttp websocket request handler"""
         if request.remote not in self.socket_info.get("remote_ips", []):
@@ -175,8 +253,10 @@ class SocketApp:
             await ws.prepare(request)
             async for msg in ws:
                 match msg.type:
-                    case aiohttp.WSMsgType.TEXT:
-                        await self.reply_ws(msg.data, request.remote, ws)
+                    case aiohttp.WSMsgType.TEXT | aiohttp.WSMsgType.BINARY:
+                        data = self.wire.decode(msg.data, self.wires.get(request.remote, "json"))
+                        for data_dct in data if isinstance(data, list) else [data]:
+                            await self.reply_ws(data_dct, request.remote, ws)
                     case aiohttp.WSMsgType.ERROR:
                         self.log_app.add(f"error web socket {request.remote} {ws.exception()} {msg.type=}", tpe="error")
                     case _:
@@ -185,6 +265,50 @@ class SocketApp:
             pass
         except Exception as e:
             self.log_app.add(f"error web socket {request.remote} {e=}", tpe="error")
+        # the wire format holds for this connection, a host that connects again without hello gets json
+        if self.wires.pop(request.remote, None):
+            self.log_app.add(f"Websocket {request.remote} closed, wire format json")
+        return ws
+
+    async def subscribe_handler(self, request):
+        """aiohttp websocket handler of the subscribers to the stream, a subscriber sends
+           {"type": "sub", "topics": [..]} to (re)subscribe and gets the updates of those topics from then on"""
+        if request.remote not in self.socket_info.get("remote_ips", []) + self.socket_info.get("sub_ips", []):
+            self.log_app.add(f"rejected subscriber {request.remote=}", tpe="error")
+            return web.Response(text=f"<p>NOK - rejected</p>", status=400)
+        ws, topics = web.WebSocketResponse(), set()
+        sender = None
+        try:
+            await ws.prepare(request)
+            sender = asyncio.create_task(self.stream.serve(ws, request.remote, topics))
+            async for msg in ws:
+                match msg.type:
+                    case aiohttp.WSMsgType.TEXT:
+                        try:
+                            data_dct = self.wire.decode(msg.data)
+                        except ValueError:
+                            data_dct = None
+                        # anything else than a sub message is answered, the subscription stays as it is
+                        if not isinstance(data_dct, dict) or data_dct.get("type", None) != "sub" or \
+                                not isinstance(data_dct.get("topics", []), list):
+                            self.log_app.add(f"Subscriber {request.remote} sent {msg.data[:80]!r}", tpe="debug")
+                            await ws.send_str(json.dumps({"type": "error", "error": "not a sub message with a topics list"}))
+                            continue
+                        new = self.stream.subscribe(topics, data_dct.get("topics", []))
+                        topics.clear()
+                        topics.update(new)
+                        self.log_app.add(f"Subscriber {request.remote} topics {sorted(topics)}")
+                        await ws.send_str(json.dumps({"type": "sub", "topics": sorted(topics), "seq": self.stream.seq}))
+                    case aiohttp.WSMsgType.ERROR:
+                        self.log_app.add(f"error subscriber {request.remote} {ws.exception()} {msg.type=}", tpe="error")
+        except ConnectionResetError as e:
+            pass
+        except Exception as e:
+            self.log_app.add(f"error subscriber {request.remote} {e=}", tpe="error")
+        finally:
+            if sender:
+                sender.cancel()
+            self.stream.subscribe(topics, [])
         return ws
 
 
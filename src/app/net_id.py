@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+# encoding=utf-8
+"""contains the network identity of the pi"""
+import socket
+import time
+
+from ..config import net_id_refresh, net_id_retry
+
+
+class NetId:
+    """ the local ip address, resolved once and again after net_id_refresh seconds, so a new address of the pi
+        (dhcp, other interface) is picked up without a socket for every call
+        without a default route the address is "" and it is tried again after net_id_retry seconds """
+
+    def __init__(self, log_app, *args, **kwargs):
+        self.log_app = log_app
+        self.ip, self.resolved = "", None
+        super().__init__(*args, **kwargs)
+
+    def resolve(self):
+        """ resolve the local ip address of the default route, connect on UDP sends no packets """
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sc:
+                sc.connect(("8.8.8.8", 80))
+                ip = sc.getsockname()[0]
+        except OSError as e:
+            ip = ""
+            if self.ip or self.resolved is None:
+                self.log_app.add(f"No local ip address, no default route? {e}", tpe="error")
+        if ip and ip != self.ip:
+            self.log_app.add(f"Local ip address {ip}{f' was {self.ip}' if self.ip else ''}")
+        self.ip, self.resolved = ip, time.monotonic()
+        return ip
+
+    @property
+    def my_ip(self):
+        """ return the local ip address, resolved again when it is too old """
+        if self.resolved is None or time.monotonic() - self.resolved > (net_id_refresh if self.ip else net_id_retry):
+            self.resolve()
+        return self.ip
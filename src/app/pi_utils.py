@@ -3,19 +3,31 @@
 from .logger import Logger
 from .pickleit import PickleIt
 from .my_socket import SocketApp
-from .tmux import TMux
+from .net_id import NetId
+from .metrics import Metrics
 
 from rich.console import Console
 
+from concurrent.futures import ThreadPoolExecutor
+
 class SysEnv:
     def __init__(self):
         return
 
-    def install(self, socket_info):
+    def install(self, socket_info, headless=False):
         self.console = Console(color_system="truecolor")
-        self.tmux = TMux()
-        self.log_app = Logger(self.console, self.tmux.log_console)
-        self.pickle_app = PickleIt(self.log_app)
-        self.socket_app = SocketApp(socket_info, self.log_app) if socket_info else None
+        # headless there are no tmux sessions and the log goes to the console, e.g. the journal of systemd
+        if headless:
+            self.tmux = None
+        else:
+            from .tmux import TMux
+            self.tmux = TMux()
+        self.log_app = Logger(self.console, self.tmux.log_console if self.tmux else self.console)
+        # one thread for the writes to disk, keeps them in order and off the event loop
+        self.disk_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk_io")
+        self.metrics = Metrics()
+        self.pickle_app = PickleIt(self.log_app, self.disk_io, self.metrics)
+        self.net_id = NetId(self.log_app)
+        self.socket_app = SocketApp(socket_info, self.log_app, self.net_id, self.metrics) if socket_info else None
 
 pi = SysEnv()
\ No newline at end of file
@@ -3,31 +3,99 @@
 import datetime
 import os
 import pickle
+import time
 
-from ..config import pickle_file
+from ..config import pickle_file, pickle_save_s, journal_file
 
 class PickleIt:
-    """ this is a class to pickle data to a file and unpickle it"""
+    """ this is a class to pickle data to a file and unpickle it
+        the pickle file is a snapshot, the changes after it are appended to a journal as small pickled records,
+        at a restore the journal is replayed on the snapshot """
 
-    def __init__(self, log_app, *args, **kwargs):
+    def __init__(self, log_app, disk_io, metrics, *args, **kwargs):
         self.log_app = log_app
+        self.disk_io = disk_io  # thread writing to disk
+        self.metrics = metrics
+        self.saved = None  # time.monotonic() of the last save
+        self.journal = None  # journal file, opened by the disk_io thread
         super().__init__(*args, **kwargs)
 
-    def var_save(self, selfie):
-        with open(pickle_file, "wb") as f:
-            pickle.dump(selfie.data, f, pickle.HIGHEST_PROTOCOL)
+    def var_save(self, selfie, force=False):
+        """ save selfie.data at most once every pickle_save_s seconds, unless forced (new period, new peak, stop)
+            the data is pickled here, so a consistent copy, and written to disk by the disk_io thread """
+        if not force and self.saved is not None and time.monotonic() - self.saved < pickle_save_s:
+            return
+        self.saved = time.monotonic()
+        self.disk_io.submit(self.var_write, pickle.dumps(selfie.data, pickle.HIGHEST_PROTOCOL))
+
+    def var_write(self, blob):
+        """ write the pickled data to a temporary file first, so a crash while writing leaves the previous file intact """
+        tmp_file = f"{pickle_file}.tmp"
+        try:
+            with self.metrics.pickle_save.time(), open(tmp_file, "wb") as f:
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, pickle_file)
+            # the snapshot has all the records of the journal, start it again
+            if self.journal:
+                self.journal.close()
+            self.journal = open(journal_file, "wb")
+        except OSError as e:
+            self.log_app.add(f"!! err_pickle_save {pickle_file} {e}", tpe="error")
+
+    def journal_add(self, record):
+        """ append the record to the journal, written to disk by the disk_io thread """
+        self.disk_io.submit(self.journal_write, pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+
+    def journal_write(self, blob):
+        try:
+            if not self.journal:
+                self.journal = open(journal_file, "ab")
+            self.journal.write(blob)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except OSError as e:
+            self.log_app.add(f"!! err_journal_write {journal_file} {e}", tpe="error")
+
+    def journal_replay(self, selfie):
+        """ apply the records of the journal after the snapshot to selfie.data, until the end of the journal,
+            a record cut off by a crash, or a record of another day, return the number of records applied """
+        applied = 0
+        if not os.path.exists(journal_file):
+            return applied
+        with open(journal_file, "rb") as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    self.log_app.add(f"!! {journal_file} cut off after {applied} records {e!r}", tpe="error")
+                    break
+                if record[0] <= selfie.data.get("journal_seq", 0):
+                    continue  # already in the snapshot
+                if not selfie.journal_apply(record):
+                    break
+                applied += 1
+        return applied
 
     def var_restore(self, selfie):
-        """This script manages the pickle load from a file"""
+        """This script manages the pickle load from a file, then the journal is replayed and the pointers are set"""
         if os.path.exists(pickle_file):
             try:
                 with open(pickle_file, "rb") as f:
                     selfie.data = pickle.load(f)
-                self.log_app.add(f"{pickle_file} loaded")
+                selfie.set_pointers()
+                self.log_app.add(f"{pickle_file} loaded, {self.journal_replay(selfie)} records of {journal_file} applied")
             except Exception as e:
                 self.log_app.add(f"!! err_pickle_load {pickle_file} {e}", tpe="error")
         else:
             self.log_app.add(f"{pickle_file} not found, started from zero", tpe="error")
-            self.var_save(selfie)
+        selfie.set_pointers()
+        # the Σ € Utilities row is derived from the other rows, the journal does not update it
+        selfie.sum_utilities
+        # a new snapshot with the journal applied, the journal starts again
+        self.var_save(selfie, force=True)
 
 
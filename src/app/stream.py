@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# encoding=utf-8
+"""contains the stream of live updates to the subscribers of the /sub websocket
+
+an update is encoded once and appended to a ring shared by all subscribers, each subscriber has its own cursor
+(sequence number) in the ring, so an update costs the same whatever the number of subscribers.
+a subscriber that falls behind more than the ring loses the oldest updates and is told how many of its topics.
+"""
+import asyncio
+import collections
+import itertools
+import json
+
+
+class Stream:
+    """ the ring of updates per topic and the subscribers to them """
+
+    topics = ["telegram", "phases", "peak", "usage"]
+
+    def __init__(self, log_app, json_default, depth=256):
+        self.log_app = log_app
+        self.json_default = json_default          # encoder of what json does not know, f.i. datetime
+        self.ring = collections.deque(maxlen=depth)  # (seq, topic, payload) of the last updates
+        self.seq = 0                              # sequence number of the last update
+        self.published = collections.Counter()    # topic -> number of updates
+        self.subscribed = collections.Counter()   # topic -> number of subscribers
+        self.event = asyncio.Event()              # set at every update, wakes the subscribers
+
+    def publish(self, topic, make):
+        """ add the update of topic to the ring, make() returns the data and is only called when there are subscribers
+            never waits, the subscribers take the update from the ring at their own pace """
+        if not self.subscribed[topic]:
+            return
+        self.seq += 1
+        self.published[topic] += 1
+        self.ring.append((self.seq, topic, json.dumps({"type": topic, "seq": self.seq, "data": make()},
+                                                      separators=(",", ":"), default=self.json_default)))
+        self.event.set()
+        self.event.clear()
+
+    def subscribe(self, topics, new):
+        """ change the topics of a subscriber, return the new topics known """
+        new = set(x for x in new if x in self.topics)
+        self.subscribed.subtract(topics - new)
+        self.subscribed.update(new - topics)
+        return new
+
+    async def serve(self, ws, ip, topics):
+        """ send the updates of the topics (set, changed in place by the handler) to the subscriber until it is gone """
+        cursor, passed = self.seq + 1, collections.Counter(self.published)  # updates per topic before the cursor
+        while not ws.closed:
+            if self.seq < cursor:
+                await self.event.wait()
+                continue
+            # what is in the ring from the cursor is taken at once, the ring can change while sending
+            first, oldest, dropped = cursor, self.ring[0][0], 0
+            if oldest > cursor:
+                # only the lost updates of the topics of the subscriber count
+                in_ring = collections.Counter(topic for _, topic, _ in self.ring)
+                dropped = sum(self.published[x] - in_ring[x] - passed[x] for x in topics)
+                passed = self.published - in_ring
+                cursor = oldest
+            updates = list(itertools.islice(self.ring, cursor - oldest, None))
+            cursor = updates[-1][0] + 1
+            passed.update(topic for _, topic, _ in updates)
+            if dropped:
+                self.log_app.add(f"Subscriber {ip} too slow, {dropped} updates dropped", tpe="debug")
+                await ws.send_str(json.dumps({"type": "dropped", "seq": first, "count": dropped}))
+            for seq, topic, payload in updates:
+                if topic in topics:
+                    await ws.send_str(payload)
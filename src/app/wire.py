@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# encoding=utf-8
+"""contains the wire formats of the websocket messages {"type", "cmd", "th", "val"}
+
+- json: minified json, the default, also for peers that do not negotiate
+- msgpack: when the msgpack package is installed
+- struct: binary, a header followed by the messages with type, cmd and th as index in the schema and val as float64,
+  the single flag of the header tells a message (dict) from a list of messages, so the shape is the one of json
+
+a peer negotiates with {"type": "hello", "wire": [formats it prefers, best first]} and gets the chosen format and
+the schema back in json
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Wire:
+    """ encode and decode the websocket messages in the negotiated wire format """
+
+    types = ["th", "cum", "usage", "hello"]
+    cmds = ["set", "ask", "reply", "cum", "usage"]
+    header = struct.Struct("<2sBBH")  # magic, version, flags, number of messages
+    message = struct.Struct("<BBBd")  # type, cmd, th (index in ths, 255 = name follows), val
+    magic, version, th_name, single = b"P1", 2, 255, 1  # single: flag of a message that is not in a list
+
+    def __init__(self, ths, json_default):
+        self.ths = list(ths)[:self.th_name]  # the things of ths_map, the index is sent instead of the name
+        self.th_index = dict((th, x) for x, th in enumerate(self.ths))
+        self.json_default = json_default     # encoder of what json does not know, f.i. datetime
+        self.formats = ["struct"] + (["msgpack"] if msgpack else []) + ["json"]
+
+    @property
+    def schema(self):
+        """ the schema of the messages for the peer """
+        return {"keys": ["type", "cmd", "th", "val"], "types": self.types, "cmds": self.cmds, "ths": self.ths,
+                "struct": {"header": self.header.format, "message": self.message.format, "th_name": self.th_name,
+                           "magic": self.magic.decode(), "version": self.version, "single": self.single}}
+
+    def negotiate(self, asked):
+        """ return the first format asked that is supported, json if none """
+        return next((x for x in asked if x in self.formats), "json")
+
+    def encode(self, data, wire="json"):
+        """ return the message (dict) or list of messages as str (json) or bytes (msgpack, struct)
+            struct falls back to json for messages outside the schema, f.i. a val that is not a number """
+        if wire == "struct":
+            try:
+                return self.encode_struct(data if isinstance(data, list) else [data], not isinstance(data, list))
+            except (KeyError, ValueError, TypeError, struct.error):
+                wire = "json"
+        if wire == "msgpack" and msgpack:
+            return msgpack.packb(data, default=self.json_default)
+        return json.dumps(data, separators=(",", ":"), default=self.json_default)
+
+    def encode_struct(self, messages, single=False):
+        parts = [self.header.pack(self.magic, self.version, self.single if single else 0, len(messages))]
+        for msg in messages:
+            if set(msg) != {"type", "cmd", "th", "val"}:
+                raise KeyError(f"{msg} not in schema")
+            # only numbers, float() would also take "12" or True and the peer would get another type back
+            if not isinstance(msg["val"], (int, float)) or isinstance(msg["val"], bool):
+                raise TypeError(f"{msg['val']!r} is not a number")
+            th_n = self.th_index.get(msg["th"], self.th_name)
+            parts.append(self.message.pack(self.types.index(msg["type"]), self.cmds.index(msg["cmd"]), th_n,
+                                           msg["val"]))
+            if th_n == self.th_name:
+                th = msg["th"].encode()
+                parts.append(bytes([len(th)]) + th)
+        return b"".join(parts)
+
+    def decode(self, payload, wire="json"):
+        """ return the message (dict) or list of messages of the payload, a binary payload is struct or msgpack """
+        if isinstance(payload, str):
+            return json.loads(payload)
+        if payload[:2] == self.magic:
+            return self.decode_struct(payload)
+        if msgpack:
+            return msgpack.unpackb(payload)
+        raise ValueError(f"binary payload of {len(payload)} bytes, not {wire}")
+
+    def decode_struct(self, payload):
+        magic, version, flags, count = self.header.unpack_from(payload)
+        if version != self.version:
+            raise ValueError(f"struct version {version}, expected {self.version}")
+        messages, pos = [], self.header.size
+        for _ in range(count):
+            tpe, cmd, th_n, val = self.message.unpack_from(payload, pos)
+            pos += self.message.size
+            if th_n == self.th_name:
+                th = payload[pos+1:pos+1+payload[pos]].decode()
+                pos += 1 + payload[pos]
+            else:
+                th = self.ths[th_n]
+            messages.append({"type": self.types[tpe], "cmd": self.cmds[cmd], "th": th, "val": val})
+        return messages[0] if flags & self.single and count == 1 else messages
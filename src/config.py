@@ -2,9 +2,16 @@
 from collections import namedtuple
 
 pickle_file = "data.pickle"
+pickle_save_s = 600  # seconds between the saves of the pickle file, new periods and new peaks are saved right away
+journal_file = "data.journal"  # the changes of every telegram since the last save of the pickle file
 dir_history = "./history/"
+history_db = "./history/history.db"  # SQLite database with the readings and the usage of the ended periods
+dir_telegrams = "./telegrams/"  # recorded telegrams, used by bench.py and the tests
+dir_replay = "./replay/"  # working directory of a replay, made empty at the start, so the live data is left alone
 log_name = "log_info"
 log_file = f"{log_name}.log"
+net_id_refresh = 300  # seconds before the local ip address is resolved again
+net_id_retry = 30  # seconds before trying again when there is no local ip address
 
 obis_el = namedtuple('OBIS', ['th_n', 'class_id', 'description'])
 
@@ -79,3 +86,11 @@ usage_rows = ["+Day", "-Day", "+Night", "-Night", "Σ kWh", "+€ Day", "-€ Da
                             "Σ € kWh", "m3 Gas", "Σ € Gas", "m3 Water", "Σ € Water"]
 rate_columns = ["Rate", "€/kWh Day", "€/kWh Night", "€/m3 Gas", "€/m3 Water"]
 day_peak_columns = ["Day-3", "Day-2", "Day-1", "Today"]
+register_modulus = 10**6  # the kWh registers of the meter (6 digits before the decimal point) roll over to 0 here
+
+# time series of the meter readings, column -> how the 1 minute and 15 minute tiers aggregate the seconds
+dir_series = "./history/series/"
+series_columns = {"kW_plus": "mean", "kW_min": "mean", "V_L1": "mean", "V_L2": "mean", "V_L3": "mean",
+                  "A_L1": "mean", "A_L2": "mean", "A_L3": "mean", "gas_meter": "last", "water_meter": "last"}
+# tier -> seconds per record, days kept; a year of 1s records is 44 bytes * 86400 * 366 = 1.4 GB
+series_tiers = {"1s": (1, 366), "1m": (60, 3660), "15m": (900, 3660)}
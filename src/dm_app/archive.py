@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+
+import datetime
+import gzip
+
+from ..app import pi
+
+from ..config import dir_history
+
+from .batch_writer import BatchWriter
+
+
+class TelegramArchive(BatchWriter):
+    """ this is a class to keep the raw telegrams in a gzip compressed archive per day in the history directory,
+        one gzip member per batch, the archive can be replayed, see BusMeter.task_replay """
+
+    def __init__(self, batch_s=60, keep_days=31):
+        super().__init__(batch_s)
+        self.keep_days = keep_days  # days of archives kept in the history directory
+        self.batch = []
+        self.day = datetime.date.today()
+
+    archive_n = lambda self, day: f"{dir_history}{day.isoformat()}_telegrams.p1.gz"
+
+    def add(self, telegram):
+        """ add a CRC-valid telegram, the bytes are copied as the telegram buffer slot will be reused """
+        if (day := datetime.date.today()) != self.day:
+            # rotate, the collected telegrams belong to the archive of the previous day
+            self.flush()
+            pi.disk_io.submit(self.clean, day)
+            self.day = day
+        self.batch.append(bytes(telegram))
+        self.flush_due()
+
+    def take(self):
+        batch, self.batch = self.batch, []
+        return [(self.archive_n(self.day), batch)] if batch else []
+
+    def write(self, file_n, batch):
+        # runs in the disk_io thread, append mode adds a gzip member to the archive
+        with gzip.open(file_n, "ab") as f:
+            f.writelines(batch)
+
+    def clean(self, today):
+        # runs in the disk_io thread
+        self.remove_days(self.archive_n, today, self.keep_days, "Telegram archive")
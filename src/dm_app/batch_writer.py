@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+import datetime
+import glob
+import os
+import time
+
+from ..app import pi
+
+
+class BatchWriter:
+    """ this is the base class of the stores of the meter (archive, time series, history database)
+        what is added is collected in memory in self.batch and written in batches by the disk_io thread,
+        the subclass returns in take() the arguments of its write() in the disk_io thread and empties self.batch """
+
+    def __init__(self, batch_s):
+        self.batch_s = batch_s  # seconds collected before writing
+        self.last_flush = time.monotonic()
+
+    def flush_due(self):
+        """ flush when batch_s seconds passed since the last flush """
+        if time.monotonic() - self.last_flush > self.batch_s:
+            self.flush()
+
+    def flush(self):
+        """ hand the collected batch to the disk_io thread """
+        for args in self.take():
+            pi.disk_io.submit(self.write, *args)
+        self.last_flush = time.monotonic()
+
+    def remove_days(self, day_n, today, keep_days, what):
+        # runs in the disk_io thread, remove the files of day_n(day) older than keep_days,
+        # the file names only differ in the iso day, so older is a smaller name
+        oldest = day_n(today - datetime.timedelta(days=keep_days))
+        for file_n in glob.glob(day_n(today).replace(today.isoformat(), "*")):
+            if file_n < oldest:
+                os.remove(file_n)
+                pi.log_app.add(f"{what} {file_n} removed")
@@ -1,95 +1,225 @@
 #!/usr/bin/python3
+import array
 import asyncio
+import contextlib
 import datetime
+import functools
+import glob
+import gzip
+import importlib
 import re
+import signal
 
-import crcmod.predefined
+try:
+    import crcmod.predefined
+except ImportError:
+    crcmod = None
 import serial_asyncio
 
-from rich.live import Live
 from rich.text import Text
 
 from ..app import pi
 
 from .usage import Usage
-from .screens import Screens
+from .obis_parser import ObisParser
+from .telegram import TelegramBuffer
+from .archive import TelegramArchive
+from .series import TimeSeries
+from .history_db import HistoryDB
 
 from ..config import obiscodes
 
 
+
+def crc16_table():
+    """ return the lookup table of CRC16/ARC, reflected polynomial 0xA001 """
+    table = array.array("H", range(256))
+    for x in range(256):
+        for _ in range(8):
+            table[x] = (table[x] >> 1) ^ 0xA001 if table[x] & 1 else table[x] >> 1
+    return table
+
+
+class Crc16Table:
+    """ CRC16/ARC (crc16 in crcmod) with a lookup table in an array, pure python
+        same interface as crcmod: new() for a fresh copy, update(data) and crcValue """
+
+    table = crc16_table()
+
+    def __init__(self):
+        self.crcValue = 0
+
+    def new(self, arg=None):
+        crc = Crc16Table()
+        if arg is not None:
+            crc.update(arg)
+        return crc
+
+    def update(self, data):
+        crc, table = self.crcValue, self.table
+        for b in data:
+            crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+        self.crcValue = crc
+
+
+def crc16_backends():
+    """ return dict of the available CRC16 backends, fastest first """
+    backends = {}
+    if crcmod and importlib.import_module("crcmod.crcmod")._usingExtension:
+        backends["crcmod C extension"] = crcmod.predefined.PredefinedCrc('crc16')
+    backends["table"] = Crc16Table()
+    if crcmod and "crcmod C extension" not in backends:
+        backends["crcmod python"] = crcmod.predefined.PredefinedCrc('crc16')
+    return backends
+
+
+def crc16_select():
+    """ check once that the backends give the check value of CRC16/ARC, in one go and in pieces as the telegrams arrive
+        return name and crc engine of the fastest backend that is right, and the names of the ones that are not """
+    right, wrong = {}, []
+    for name, crc in crc16_backends().items():
+        pieces = crc.new(memoryview(b"1234"))
+        pieces.update(memoryview(b"56789"))
+        if crc.new(b"123456789").crcValue == pieces.crcValue == 0xBB3D:
+            right[name] = crc
+        else:
+            wrong.append(name)
+    name = next(iter(right))
+    return name, right[name], wrong
+
+
+# the crc16 engine is selected and built once, each telegram starts from a fresh copy with crc16.new()
+crc16_name, crc16, crc16_wrong = crc16_select()
+
+# the meter runs on Belgian time, the daylight saving time flag S (summer) or W (winter) gives the offset
+p1_tz = {"S": datetime.timezone(datetime.timedelta(hours=2), "CEST"),
+         "W": datetime.timezone(datetime.timedelta(hours=1), "CET")}
+
+
+@functools.lru_cache(maxsize=64)
+def p1_time(ts):
+    """ decode the P1 timestamp YYMMDDhhmmssX by position into a timezone aware datetime
+        the cache serves the timestamps repeated every telegram, like the 13 month peaks """
+    if len(ts) != 13:
+        raise ValueError("expecting 13 characters")
+    return datetime.datetime(2000 + int(ts[0:2]), int(ts[2:4]), int(ts[4:6]), int(ts[6:8]), int(ts[8:10]),
+                             int(ts[10:12]), tzinfo=p1_tz[ts[12]])
+
+
 class InputChunkProtocol(asyncio.Protocol):
+    """ frame the P1 telegrams as the bytes arrive: from the / header line up to the ! + CRC16 checksum line
+        the bytes are kept once in the telegram buffer and complete telegrams are put on the telegrams queue """
 
-    p1line = bytearray()
+    def __init__(self, telegrams):
+        self.telegrams = telegrams  # asyncio.Queue with the telegrams, None if the connection is lost
+        self.p1buffer = TelegramBuffer(crc16)
 
     def connection_made(self, transport):
         self.transport = transport
 
     def connection_lost(self, exc):
-        self.transport.loop.stop()
-
-    def data_received(self, data):
-        # stop callbacks again immediately
-        InputChunkProtocol.p1line += data
-        self.pause_reading()
+        # tell the main loop no telegrams will follow
+        self.put_telegram(None)
 
-    def pause_reading(self):
-        # This will stop the callbacks to data_received
-        self.transport.pause_reading()
+    def put_telegram(self, telegram):
+        # the main loop is behind if the queue is full, drop the oldest telegram as the newest is more relevant
+        # the queue must stay shorter than the slots in the telegram buffer minus the one in the making and in use
+        if self.telegrams.full():
+            self.telegrams.get_nowait()
+            self.telegrams.task_done()
+            pi.log_app.add("Telegram queue full, oldest telegram dropped", tpe="error")
+        self.telegrams.put_nowait(telegram)
 
-    def resume_reading(self):
-        # This will start the callbacks to data_received again with all data that has been received in the meantime.
-        self.transport.resume_reading()
+    def data_received(self, data):
+        for telegram in self.p1buffer.feed(data):
+            self.put_telegram(telegram)
 
 
-class BusMeter(Screens, Usage):
-    """ this is a class to read data from a digital meter connected to the P1 port """
+class BusMeter(Usage, ObisParser):
+    """ this is a class to read data from a digital meter connected to the P1 port
+        the meter is headless, ScreenMeter adds the Live screens on the console """
 
-    def __init__(self, serial_port):
+    def __init__(self, serial_port, meter_info=None):
         self.serial_port = serial_port
-        self.p1telegram = bytearray()
+        self.meter_info = meter_info or {}
+        # parser engine: "compiled" (table driven on bytes) or "regex" (parsetelegramline)
+        self.parser = self.meter_info.get("parser", "compiled")
+        # keep the raw telegrams in a daily archive, but not when replaying them
+        self.archive = TelegramArchive(self.meter_info.get("capture_batch", 60), self.meter_info.get("capture_days", 31)) \
+            if self.meter_info.get("capture") and not self.meter_info.get("replay") else None
+        # keep the readings of every second in a time series, not when replaying either
+        self.series = TimeSeries(self.meter_info.get("series_batch", 60)) \
+            if self.meter_info.get("series") and not self.meter_info.get("replay") else None
+        # keep the readings and the usage of the ended periods in SQLite, not when replaying either
+        self.history = HistoryDB(self.meter_info.get("history_batch", 60), self.meter_info.get("history_days", 7)) \
+            if self.meter_info.get("history_db") and not self.meter_info.get("replay") else None
+        self.p1telegram = None
         self.obis_dict = {}
         self.bus = {}
         super().__init__()
 
     async def serial_start(self):
+        self.telegrams = asyncio.Queue(maxsize=5)
         self.transport, self.protocol = await serial_asyncio.create_serial_connection(
-            asyncio.get_event_loop(), InputChunkProtocol, self.serial_port, baudrate=115200, xonxoff=1)
+            asyncio.get_event_loop(), lambda: InputChunkProtocol(self.telegrams),
+            self.serial_port, baudrate=115200, xonxoff=1)
+
+
+    async def replay_start(self):
+        """ replay recorded telegrams instead of reading the serial port """
+        self.telegrams = asyncio.Queue(maxsize=5)
+        self.transport, self.protocol = None, InputChunkProtocol(self.telegrams)
+        self.replay_task = asyncio.create_task(
+            self.task_replay(self.meter_info["replay"], self.meter_info.get("replay_speed", 0)))
 
+    async def task_replay(self, replay, speed):
+        """ feed the telegrams of the recorded files (raw or gzipped) matching replay through the same framing,
+            CRC and parsing as the serial port, speed times faster than the meter (1 telegram per second)
+            or as fast as possible when speed is 0, each telegram is processed before the next one is fed """
+        for file_n in sorted(glob.glob(replay)):
+            pi.log_app.add(f"Replay {file_n} at speed {speed or 'max'}")
+            with (gzip.open if file_n.endswith(".gz") else open)(file_n, "rb") as f:
+                chunk = bytearray()
+                for line in f:
+                    chunk += line
+                    if line[:1] == b"!":
+                        self.protocol.data_received(bytes(chunk))
+                        chunk.clear()
+                        await self.telegrams.join()
+                        await asyncio.sleep(1 / speed if speed else 0)
+        self.protocol.connection_lost(None)
 
     def serial_bye(self, msg):
         pi.log_app.add(msg, tpe="debug")
-        self.transport.close()
+        if self.transport:
+            self.transport.close()
 
     def checkcrc(self, p1telegram):
         # check CRC16 checksum of telegram and return False if not matching
-        # split telegram in contents and CRC16 checksum (format:contents!crc)
-        p1contents = ""
-        for match in re.compile(b'\r\n(?=!)').finditer(p1telegram):
-            p1contents = p1telegram[:match.end() + 1]
-            # CRC is in hex, so we need to make sure the format is correct
-            givencrc = hex(int(p1telegram[match.end() + 1:].decode('ascii').strip(), 16))
-        # calculate checksum of the contents
-        calccrc = hex(crcmod.predefined.mkPredefinedCrcFun('crc16')(p1contents))
+        # the checksum is calculated while the telegram was received and compared with the one in the ! line
+        if p1telegram.checksum is None:
+            pi.metrics.crc_failures.inc()
+            pi.log_app.add(f"Error telegram checksum missing: {bytes(p1telegram)[-20:]}", tpe="error")
+            return False
         # check if given and calculated match
-        if givencrc != calccrc:
-            pi.log_app.add(f"Error telegram checksum mismatch: {givencrc=}, {calccrc=}", tpe="error")
+        if p1telegram.checksum != p1telegram.crc:
+            pi.metrics.crc_failures.inc()
+            pi.log_app.add(f"Error telegram checksum mismatch: givencrc={hex(p1telegram.checksum)}, "
+                           f"calccrc={hex(p1telegram.crc)}", tpe="error")
             return False
         return True
 
     def ts_obj(self, ts):
         # parse timestamp from telegram
         # format:YYMMDDhhmmssX, where X is the daylight saving time flag S or W
-        # convert to format:YYYY-MM-DD hh:mm:ss or YYYY-MM-DD if time is zero
-        if len(ts) != 13:
-            pi.log_app.add(f"Error expecting 13 characters: {ts=}", tpe="error")
-        if ts[12] not in ["S", "W"]:
-            pi.log_app.add(f"Error expecting S or W at the end of {ts=}", tpe="error")
+        # convert to a timezone aware datetime, so the hour of the switch from summer to winter time is not ambiguous
         try:
-            dt = datetime.datetime.strptime(ts[:-1], '%y%m%d%H%M%S')
-        except Exception as e:
+            return p1_time(ts)
+        except KeyError:
+            pi.log_app.add(f"Error expecting S or W at the end of {ts=}", tpe="error")
+        except ValueError as e:
             pi.log_app.add(f"Error parsing timestamp: {ts=} {e=}", tpe="error")
-            dt=datetime.datetime.now()
-        return dt
+        return datetime.datetime.now().astimezone()
 
     ts_str = lambda self, dt: dt.strftime('%Y-%m-%d %H:%M:%S')
 
@@ -199,74 +329,99 @@ class BusMeter(Screens, Usage):
             case _:  # unknown class_id
                 return ret_val({"value": "??"}, Text(f"??{class_id=} {p1line=}", "bold magenta"))
 
+    def parse_telegram(self, p1telegram):
+        """ parse all lines of the telegram with the selected parser engine and return the table of results
+            self.changed_obis is set with the OBIS codes of the lines that changed since the previous telegram """
+        self.obis_dict = {}
+        if self.parser == "compiled":
+            self.changed_obis = set()
+            return [self.parse_line(bytes(line)) for line in p1telegram if line]
+        p1_table = [self.parsetelegramline(bytes(line).decode('ascii')) for line in p1telegram if line]
+        # the regex parser decodes every line, so all have changed
+        self.changed_obis = set(self.obis_dict)
+        return p1_table
+
+    def screen_open(self):
+        """ return the context of the screen, headless there is none """
+        return contextlib.nullcontext()
+
+    def screen_update(self, updated):
+        """ update the screen after a valid telegram, updated is True when the usage was updated, headless nothing """
+        return
 
     async def main_loop(self):
-        # 1. get the event loop
+        # 1. get the event loop, a stop by systemd (SIGTERM) cancels the main loop as ctrl-c does, so run() saves all
         self.loop = asyncio.get_running_loop()
-        # 2. start the socket server and set the buffer
-        await self.serial_start()
+        self.loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        # 2. start the serial port, or the replay of recorded telegrams, and set the buffer
+        await (self.replay_start() if self.meter_info.get("replay") else self.serial_start())
         # 3. start the socket server
         if pi.socket_app:
             await pi.socket_app.server_start(self)
-        # 4. set the last live refresh time
-        last_live, refresh_s = None, 3
-        # 5. start the main loop with the live screens
-        with Live(self.layout, console=pi.console, auto_refresh=False) as live:
+        # 4. start the main loop with the screen, if any
+        with self.screen_open():
             while True:
-                self.togather = []
                 try:
-                    # read input from serial port
-                    self.protocol.resume_reading()
-                    p1line = InputChunkProtocol.p1line
-                    # read line by line, but cut between / and the ! + CRC16 checksum in the last line
-                    # if P1 telegram starts with /, a new telegram is started
-                    if "/" in InputChunkProtocol.p1line.decode('ascii'):  # "Found beginning of P1 telegram, cut off previous data"
-                        p1line = p1line[p1line.find(b"/"):]
-                        self.p1telegram = bytearray()
-                    # catch up with the newlines
-                    done_gram = False
-                    while b'\r\n' in p1line:
-                        line, _, p1line = p1line.partition(b'\r\n')
-                        InputChunkProtocol.p1line = p1line
-                        self.p1telegram.extend(line+b'\r\n')
-                        # P1 telegram ends with ! + CRC16 checksum
-                        if done_gram := ("!" in line.decode('ascii')):
-                            break
-                    if done_gram:
-                        if self.checkcrc(self.p1telegram):  # "Checksum correct"
-                            # make the table
-                            self.obis_dict = {}
-                            self.p1_table = [self.parsetelegramline(line.decode('ascii'))
-                                             for line in self.p1telegram.split(b'\r\n') if line]
-                            if self.update_usage():
-                                if pi.socket_app:
-                                    await pi.socket_app.send_ths()
-                                self.update_layout(self.layout)
-                            if not last_live or (datetime.datetime.now() - last_live).total_seconds() > refresh_s:
-                                self.togather.append(self.loop.run_in_executor(None, live.refresh))
-                                last_live = datetime.datetime.now()
-                            self.json_file(self.data, "data.json")
-                    # make the async magic happen, but add sleep to avoid 100% cpu
-                    self.togather.append(asyncio.sleep(0))
-                    await asyncio.gather(*self.togather, return_exceptions=True)
-                    live.update(self.layout, refresh=True)
+                    # wait for the next telegram, framed by the protocol as the bytes arrive
+                    if (telegram := await self.telegrams.get()) is None:
+                        self.serial_bye("No more telegrams, serial connection lost or replay done")
+                        break
+                    self.p1telegram = telegram
+                    pi.metrics.telegrams.inc()
+                    if self.checkcrc(self.p1telegram):  # "Checksum correct"
+                        if self.archive:
+                            self.archive.add(self.p1telegram)
+                        # make the table
+                        with pi.metrics.parse.time():
+                            self.p1_table = self.parse_telegram(self.p1telegram)
+                        with pi.metrics.update_usage.time():
+                            updated = self.update_usage()
+                        if updated and self.series:
+                            self.series.add(self)
+                        if updated and self.history:
+                            self.history.add(self)
+                        if pi.socket_app:
+                            pi.socket_app.publish(self, updated)
+                        if updated and pi.socket_app:
+                            await pi.socket_app.send_ths()
+                        self.screen_update(updated)
+                        self.json_file(self.data, "data.json")
+                    self.telegrams.task_done()
                 except (asyncio.CancelledError, KeyboardInterrupt) as error:
                     self.serial_bye(f"{error}")
                     break
                 except Exception as e:
                     pi.console.print_exception(extra_lines=10, show_locals=True, width=200, word_wrap=True)
                     self.serial_bye(f"Something went wrong...{e}")
-                    pi.tmux.close_sessions()
+                    if pi.tmux:
+                        pi.tmux.close_sessions()
                     break
 
     def run(self, ths_map):
         self.ths_map = ths_map
-        # 1. build the screens layout upfront
+        # 1. start the log
         pi.log_app.log_start("Starting digital meter script")
-        self.layout = self.make_layout()
         # 2. set the default data in case no pickle file is present
         self.set_data()
-        # 3. restore the data from pickle file if present
+        # 3. restore the data from pickle file and journal if present, and set the pointers
         pi.pickle_app.var_restore(self)
-        self.set_pointers()
-        asyncio.run(self.main_loop())
+        # 4. report the CRC16 backend, open the history database
+        pi.log_app.add(f"CRC16 backend {crc16_name}" +
+                       (f", wrong check value and not used: {', '.join(crc16_wrong)}" if crc16_wrong else ""),
+                       tpe="error" if crc16_wrong else "info")
+        if self.history:
+            self.history.start()
+        try:
+            asyncio.run(self.main_loop())
+        except (asyncio.CancelledError, KeyboardInterrupt) as error:
+            pi.log_app.add(f"Stopped {error!r}", tpe="debug")
+        finally:
+            # 5. write what is pending to disk
+            pi.pickle_app.var_save(self, force=True)
+            if self.archive:
+                self.archive.flush()
+            if self.series:
+                self.series.flush()
+            if self.history:
+                self.history.close()
+            pi.disk_io.shutdown(wait=True)
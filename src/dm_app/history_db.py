@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import datetime
+import glob
+import json
+import os
+import sqlite3
+
+from ..app import pi
+
+from ..config import dir_history, history_db, usage_rows
+
+from .batch_writer import BatchWriter
+
+
+class HistoryDB(BatchWriter):
+    """ this is a class to keep the readings of every telegram and the usage of every ended period in SQLite
+        the readings are inserted one transaction per batch, the connection is only used in the disk_io thread,
+        in WAL mode so a report does not block the inserts
+        the readings are kept keep_days days, the time series keeps the seconds longer, the usage is kept forever
+        the MM-DD_data.json files in the history directory are imported once """
+
+    readings = ["kwH_day_plus", "kwH_day_min", "kwH_night_plus", "kwH_night_min", "kW_plus", "kW_min",
+                "gas_meter", "water_meter"]
+
+    def __init__(self, batch_s=60, keep_days=7):
+        super().__init__(batch_s)
+        self.keep_days = keep_days  # days of readings kept
+        self.batch = []
+        self.day = None  # day of the last reading, the old readings are removed once a day
+        self.db = None
+
+    def start(self):
+        """ open the database and import the json files, in the disk_io thread """
+        pi.disk_io.submit(self.open)
+        pi.disk_io.submit(self.import_json)
+
+    def open(self):
+        # runs in the disk_io thread
+        self.db = sqlite3.connect(history_db)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS readings (ts INTEGER PRIMARY KEY, "
+                            f"{', '.join(f'{x} REAL' for x in self.readings)})")
+            # usage of a period (Today, Week, Month, Year) that ended on day, ts is the last reading of the period
+            self.db.execute("CREATE TABLE IF NOT EXISTS usage (period TEXT, day TEXT, ts INTEGER, row TEXT, value REAL, "
+                            "PRIMARY KEY (period, day, row))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS usage_period_ts ON usage (period, ts)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS imported (file TEXT PRIMARY KEY, mtime REAL)")
+
+    def add(self, meter):
+        """ add the readings of the meter at meter.cur_time """
+        if (day := meter.cur_time.date()) != self.day:
+            self.day = day
+            midnight = meter.cur_time.replace(hour=0, minute=0, second=0, microsecond=0)
+            pi.disk_io.submit(self.clean, midnight - datetime.timedelta(days=self.keep_days))
+        values = [getattr(meter, x, None) for x in self.readings]
+        self.batch.append((int(meter.cur_time.timestamp()),
+                           *[x.get("value", None) if isinstance(x, dict) else x for x in values]))
+        self.flush_due()
+
+    def add_period(self, period, last_time, usage):
+        """ add the usage of the period that ended, last_time is the time of the last reading in the period """
+        ts, day = int(last_time.timestamp()), last_time.date().isoformat()
+        pi.disk_io.submit(self.insert_usage, [(period, day, ts, row, usage[x]) for x, row in enumerate(usage_rows)])
+
+    def take(self):
+        batch, self.batch = self.batch, []
+        return [(batch,)] if batch else []
+
+    def write(self, batch):
+        # runs in the disk_io thread, one transaction for the batch
+        try:
+            with self.db:
+                self.db.executemany(f"INSERT OR REPLACE INTO readings VALUES ({', '.join('?' * (1 + len(self.readings)))})",
+                                    batch)
+        except sqlite3.Error as e:
+            pi.log_app.add(f"!! History database, {len(batch)} readings not inserted {e}", tpe="error")
+
+    def clean(self, oldest):
+        # runs in the disk_io thread, remove the readings before oldest (datetime)
+        try:
+            with self.db:
+                removed = self.db.execute("DELETE FROM readings WHERE ts < ?", (int(oldest.timestamp()),)).rowcount
+            if removed:
+                pi.log_app.add(f"History database, {removed} readings before {oldest.date()} removed")
+        except sqlite3.Error as e:
+            pi.log_app.add(f"!! History database, old readings not removed {e}", tpe="error")
+
+    def insert_usage(self, rows):
+        # runs in the disk_io thread
+        try:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            pi.log_app.add(f"!! History database, usage not inserted {e}", tpe="error")
+
+    def import_json(self):
+        """ runs in the disk_io thread, import the usage of Today of the data.json files not imported yet,
+            the file is written at the end of the day, but overwritten with the data of the next day """
+        imported = dict(self.db.execute("SELECT file, mtime FROM imported"))
+        for file_n in sorted(glob.glob(f"{dir_history}*_data.json")):
+            if imported.get(file_n, None) == (mtime := os.path.getmtime(file_n)):
+                continue
+            try:
+                with open(file_n) as f:
+                    data = json.load(f)
+                last_time = datetime.datetime.strptime(data["cur_time"][:19], "%Y-%m-%d %H:%M:%S")
+                rows = [("Today", last_time.date().isoformat(), int(last_time.timestamp()), row, data["usage"]["Today"][x])
+                        for x, row in enumerate(usage_rows)]
+                with self.db:
+                    self.db.executemany("INSERT OR IGNORE INTO usage VALUES (?, ?, ?, ?, ?)", rows)
+                    self.db.execute("INSERT OR REPLACE INTO imported VALUES (?, ?)", (file_n, mtime))
+                pi.log_app.add(f"History database, {file_n} imported")
+            except (OSError, ValueError, KeyError, IndexError, sqlite3.Error) as e:
+                pi.log_app.add(f"!! History database, {file_n} not imported {e!r}", tpe="error")
+
+    def report(self, start, end, group="%Y-%m"):
+        """ return a future of the dict (group, row) -> sum of the usage of the days ended from start to end (datetime),
+            the group is a strftime format of the day, f.i. %Y-%m per month or %Y per year, read in the disk_io thread """
+        return pi.disk_io.submit(self.read_report, int(start.timestamp()), int(end.timestamp()), group)
+
+    def read_report(self, start, end, group):
+        # runs in the disk_io thread, the index on (period, ts) selects the days
+        return dict(((grp, row), value) for grp, row, value in self.db.execute(
+            "SELECT strftime(?, day), row, SUM(value) FROM usage WHERE ts BETWEEN ? AND ? AND period = 'Today' "
+            "GROUP BY 1, 2", (group, start, end)))
+
+    def close(self):
+        """ insert what is collected and close the database, after the other writes of the disk_io thread """
+        self.flush()
+        pi.disk_io.submit(self.db_close)
+
+    def db_close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
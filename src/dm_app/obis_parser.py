@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+import binascii
+
+from rich.text import Text
+
+from ..app import pi
+
+from ..config import obiscodes
+
+
+class ObisParser:
+    """ this is a class with a compiled, table driven parser for the telegram lines
+        one decoder per OBIS code is built once from obiscodes, the decoders work directly on the bytes of the line
+        without regex and without decoding the whole line to str
+        the result of each line is kept, only lines with other bytes than in the previous telegram are decoded again """
+
+    def __init__(self, *args, **kwargs):
+        self.decoders = self.make_decoders()
+        self.line_cache = {}       # OBIS code -> (line, result row, result dict) of the last decode
+        self.changed_obis = set()  # the OBIS codes of the lines that changed in the last telegram
+        super().__init__(*args, **kwargs)
+
+    def make_decoders(self):
+        """ return dict with the OBIS code (as bytes) and the decoder for the values of that OBIS code """
+        return dict((obis.encode(), self.make_decoder(obis, *obis_guide)) for obis, obis_guide in obiscodes.items())
+
+    def make_decoder(self, obis, th_n, class_id, description):
+        """ return the decoder for a single OBIS code, the decoder takes the list of values (bytes) between brackets
+            and returns the same result as parsetelegramline
+            and return keep, which applies the result of the previous decode again when the line did not change """
+        def ret_val(result_dct, result_str):
+            self.obis_result = result_dct
+            keep(result_dct)
+            return obis, th_n, description, result_str
+
+        def keep(result_dct):
+            self.obis_dict[obis] = result_dct
+            setattr(self, th_n, result_dct["value"])
+
+        def get_num(value_str):
+            return float(value_str) if b"." in value_str else int(value_str)
+
+        # decide once, based on the class_id, how the values must be decoded
+        match class_id:
+            case 1 | 10:  # data
+                is_vgrid = obis == "1-0:94.32.1"
+
+                def decoder(values):
+                    value = values[0].decode() if class_id == 1 else binascii.unhexlify(values[0]).decode()
+                    if is_vgrid and value not in ["230", "400"]:
+                        pi.log_app.add(f"{obis}: Grid expecting 230 or 400: {value=}", tpe="error")
+                    return ret_val({"value": value}, value)
+            case 3 | 5 | 21 | 71:  # register, demand register, register monitor, limiter
+                is_phase_v = obis in ["1-0:32.7.0", "1-0:52.7.0", "1-0:72.7.0"]
+
+                def decoder(values):
+                    value_str, _, unit = values[0].partition(b"*")
+                    value, unit = get_num(value_str), unit.decode()
+                    result_dct = {"value": value, "unit": unit}
+                    result_str = f"{value_str.decode()} {unit}"
+                    # check if all phases are above 200 V
+                    if is_phase_v and self.obis_dict.get("1-0:94.32.1", {}).get("value") == "400" and int(value) < 200:
+                        msg = f"!! PHASE DEACTIVE {result_str}"
+                        pi.log_app.add(msg, tpe="error")
+                        return ret_val(result_dct, Text(msg, "bold red"))
+                    return ret_val(result_dct, result_str)
+            case 4:  # extended register
+                meter = {"gas_meter": "Gas", "water_meter": "Water"}.get(th_n, None)
+
+                def keep(result_dct):
+                    self.obis_dict[obis] = result_dct
+                    setattr(self, th_n, result_dct["value"])
+                    if meter:
+                        self.meters[meter] = result_dct["value"]  # update self.data dict version
+
+                def decoder(values):
+                    value_time = self.ts_obj(values[0].decode())
+                    value_str, _, unit = values[1].partition(b"*")
+                    value, unit = get_num(value_str), unit.decode()
+                    res_dct = {"value": value, "unit": unit, "time": value_time}
+                    return ret_val({"value": res_dct}, f"{self.ts_str(value_time)} {value} {unit}")
+            case 7:  # profile generic
+                def decoder(values):
+                    # first no of lines, then the id's of the lines, then the values of those id's
+                    lines = int(values[0])
+                    ids = [x.decode() for x in values[1:1+2]]
+                    # expect class 4 at this point, check it for all id's
+                    if not all(x in obiscodes and obiscodes[x].class_id == 4 for x in ids):
+                        pi.log_app.add(f"!!Expecting class_id == 4 -> {ids=} in {obis=}", tpe="error")
+                    table = {}
+                    for x in range(len(ids)+1, len(values)-1, 3):
+                        value_str, _, unit = values[x+2].partition(b"*")
+                        table[self.ts_obj(values[x].decode())] = \
+                            [self.ts_obj(values[x+1].decode()), value_str.decode(), unit.decode()]
+                    return ret_val({"value": {"lines": lines, "ids": ids, "table": table}},
+                                   f"see table, month peaks ={lines}")
+            case 8:  # timestamp
+                def keep(result_dct):
+                    self.obis_dict[obis] = result_dct
+                    setattr(self, th_n, result_dct["value"])
+                    self.cur_time = result_dct["value"]
+
+                def decoder(values):
+                    value_time = self.ts_obj(values[0].decode())
+                    return ret_val({"value": value_time}, f"{self.ts_str(value_time)}")
+            case 70:  # disconnect control
+                reconnect = " press yellow button 5s" if obis == "0-0:96.3.10" else ""
+
+                def decoder(values):
+                    dc = int(values[0])
+                    if dc == 2:
+                        return ret_val({"value": dc}, Text(f"!! Reconnect={dc}{reconnect}", "bold red"))
+                    return ret_val({"value": dc}, f"{dc}")
+            case 72:  # M-Bus Client
+                devices, bus_n = {"003": "gas", "007": "water"}, int(obis[2])
+
+                def keep(result_dct):
+                    self.obis_dict[obis] = result_dct
+                    setattr(self, th_n, result_dct["value"])
+                    if result_dct["value"] in devices.values():
+                        self.bus[bus_n] = result_dct["value"]
+
+                def decoder(values):
+                    value = values[0].decode()
+                    if not (device := devices.get(value, None)):
+                        return ret_val({"value": value}, Text(f"?? device type: {value}", "bold magenta"))
+                    return ret_val({"value": device}, f"{value} -> {device}")
+            case _:  # unknown class_id
+                def decoder(values):
+                    p1line = f"{obis}({')('.join(x.decode() for x in values)})"
+                    return ret_val({"value": "??"}, Text(f"??{class_id=} {p1line=}", "bold magenta"))
+        return decoder, keep
+
+    def parse_line(self, p1line):
+        """ parse a single line (bytes) of the telegram with the compiled decoders """
+        if not p1line or p1line[:1] in [b"/", b"!"]:
+            # / FLU5\253967035_D  is the header
+            # ! 6E4B is the checksum
+            return "-", "-", "-", Text(p1line.decode(), "bold magenta")
+        # get OBIS code from line (format:OBIS(value)
+        obis, found, values = p1line.partition(b"(")
+        if not found:
+            return "-", "-", Text("?? No OBIS code in line", "bold magenta"), p1line.decode()
+        # check if OBIS code is something we know and parse it
+        if not (decoder := self.decoders.get(obis, False)):
+            return "", "", Text(f"?? OBIS code {obis.decode()} not recognised", "bold magenta"), p1line.decode()
+        decode, keep = decoder
+        # same bytes as the previous time, so same result
+        if (cached := self.line_cache.get(obis, None)) and cached[0] == p1line:
+            keep(cached[2])
+            return cached[1]
+        # values are between brackets: (value)(value)..
+        result_row = decode(values[:-1].split(b")("))
+        if obis == b"1-0:94.32.1" and cached:
+            # the grid config changed and the phase voltage check depends on it, decode all again
+            self.line_cache = {}
+        self.line_cache[obis] = (p1line, result_row, self.obis_result)
+        self.changed_obis.add(result_row[0])
+        return result_row
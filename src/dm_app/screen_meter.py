@@ -0,0 +1,8 @@
+#!/usr/bin/python3
+
+from .bus_meter import BusMeter
+from .screens import Screens
+
+
+class ScreenMeter(Screens, BusMeter):
+    """ this is the digital meter with the Live screens on the console, BusMeter is the headless meter """
@@ -1,42 +1,29 @@
 #!/usr/bin/python3
 
 from rich.layout import Layout
+from rich.live import Live
 from rich.panel import Panel
 from rich.table import Table
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn
 
-import datetime, socket
+import contextlib, datetime, threading, time
+
+from ..app import pi
 
 from ..config import rate_columns, usage_columns, usage_rows
 
 
 
 
-class Screens:
-    """ this is a class to make a screen for the console"""
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class Panels:
+    """ this is a class to make the panels of the screen, from the meter data in a ScreenSnapshot """
 
-    @property
-    def my_ip(self):  # return my ip address
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sc:
-                sc.connect(("8.8.8.8", 80))
-                return sc.getsockname()[0]
-        except Exception:
-            return ""
-
-    def make_layout(self) -> Layout:
-        """ return layout of the console"""
-        layout = Layout(name="root")
-        layout.split(Layout(name="header", size=3),
-                     Layout(name="main"))
-        layout["main"].split_row(Layout(name="left_side"), Layout(name="telegram", minimum_size=60))
-        layout["left_side"].split(Layout(name="rate", size=5),
-                                  Layout(name="usage"),
-                                  Layout(name="month_peak", size=19),
-                                  Layout(name="quarter_peak", size=7))
-        return layout
+    def panel_dirty(self, panel, *key):
+        """ return True when the inputs (key) of the panel changed since it was built the last time """
+        if self.panel_keys.get(panel, None) == key:
+            return False
+        self.panel_keys[panel] = key
+        return True
 
     def make_header(self) -> Panel:
         grid = Table.grid(expand=True)
@@ -146,15 +133,128 @@ class Screens:
                          style=self.peak_gap_style)
         return grid
 
-
     def update_layout(self, layout):
-        """ update the layout with the data from the meter"""
-        layout["header"].update(self.make_header())
-        layout["telegram"].update(Panel(self.make_telegram_table(), title="Telegram"))
-        layout["month_peak"].update(Panel(self.make_month_peak_table(), title="Months Peak"))
-        layout["usage"].update(Panel(self.make_usage_table(),
-                                           title=f"Usage since {self.ts_str(self.data['start_time'])}"))
-        layout["rate"].update(Panel(self.make_rate_table(),
-                                    title="Rate => [magenta]1:day 07:00 22:00, [blue]2:night 22:00 07:00 + weekend + holidays"))
-        layout["quarter_peak"].update(Panel(self.make_quarter_peak(),
-                                            title="Quarters Peak", border_style=self.peak_gap_style))
+        """ update the panels of the layout of which the data changed, return True when a panel was updated
+            rates only change with the rate, month peaks once a month, the usage when it changes in the shown decimals """
+        dirty = False
+        if self.panel_dirty("header", self.my_ip, getattr(self, "cur_time", None)):
+            layout["header"].update(self.make_header())
+            dirty = True
+        if self.panel_dirty("telegram", *self.p1_table):
+            layout["telegram"].update(Panel(self.make_telegram_table(), title="Telegram"))
+            dirty = True
+        if self.panel_dirty("month_peak", self.month_peak, getattr(self, "months_peak_past", None)):
+            layout["month_peak"].update(Panel(self.make_month_peak_table(), title="Months Peak"))
+            dirty = True
+        if self.panel_dirty("usage", self.cur_rate, self.data["start_time"], self.data["cur_time"].date(),
+                            *[round(v, 2) for x in usage_columns for v in self.usage[x]],
+                            *[tuple(self.day_peak[x]) for x in usage_columns if x in self.day_peak]):
+            layout["usage"].update(Panel(self.make_usage_table(),
+                                         title=f"Usage since {self.ts_str(self.data['start_time'])}"))
+            dirty = True
+        if self.panel_dirty("rate", self.cur_rate, id(self.rates_dct)):
+            layout["rate"].update(Panel(self.make_rate_table(),
+                                        title="Rate => [magenta]1:day 07:00 22:00, [blue]2:night 22:00 07:00 + weekend + holidays"))
+            dirty = True
+        if self.panel_dirty("quarter_peak", self.clock_todo, self.clock_done, self.quarter_peak, self.peak_forecast,
+                            self.month_peak["value"], self.peak_gap, self.peak_gap_style, self.cur_rate):
+            layout["quarter_peak"].update(Panel(self.make_quarter_peak(),
+                                                title="Quarters Peak", border_style=self.peak_gap_style))
+            dirty = True
+        return dirty
+
+
+class ScreenSnapshot(Panels):
+    """ copy of the meter data shown on the screen, taken on the event loop and handed to the renderer thread
+        the loop goes on with the next telegram while the renderer builds the panels from this copy """
+
+    def __init__(self, meter, panel_keys):
+        self.panel_keys = panel_keys  # of the renderer, the snapshots are built one after the other
+        self.my_ip, self.ts_str = meter.my_ip, meter.ts_str
+        if hasattr(meter, "cur_time"):
+            self.cur_time = meter.cur_time
+        # the telegram table, rates and peaks are replaced by the meter, not changed, so no copy needed
+        self.p1_table, self.rates_dct = meter.p1_table, meter.rates_dct
+        self.month_peak, self.months_peak_past = meter.month_peak, getattr(meter, "months_peak_past", {})
+        self.data = {"cur_time": meter.data["cur_time"], "start_time": meter.data["start_time"]}
+        self.usage = dict((x, v[:]) for x, v in meter.usage.items())
+        self.day_peak = dict((x, v[:]) for x, v in meter.day_peak.items())
+        self.sum_utilities = self.usage.get("Σ € Utilities", [])
+        for attr in ["cur_rate", "clock_todo", "clock_done", "quarter_peak", "peak_forecast", "peak_gap", "peak_gap_style"]:
+            setattr(self, attr, getattr(meter, attr))
+
+
+class Screens:
+    """ this is a class to make a screen for the console
+        the panels are built and rendered by a renderer thread, from the latest snapshot of the meter data """
+    def __init__(self, *args, **kwargs):
+        self.panel_keys = {}  # panel -> the inputs of the panel when it was built the last time
+        self.snapshot = None  # latest snapshot for the renderer thread, None when it took it
+        self.snapshot_ready = threading.Condition()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def my_ip(self):  # return my ip address
+        return pi.net_id.my_ip
+
+    def make_layout(self) -> Layout:
+        """ return layout of the console"""
+        layout = Layout(name="root")
+        layout.split(Layout(name="header", size=3),
+                     Layout(name="main"))
+        layout["main"].split_row(Layout(name="left_side"), Layout(name="telegram", minimum_size=60))
+        layout["left_side"].split(Layout(name="rate", size=5),
+                                  Layout(name="usage"),
+                                  Layout(name="month_peak", size=19),
+                                  Layout(name="quarter_peak", size=7))
+        return layout
+
+    @contextlib.contextmanager
+    def screen_open(self):
+        """ build the layout, start the Live screen on the console and the renderer thread, stop both at the end """
+        self.layout = self.make_layout()
+        with Live(self.layout, console=pi.console, auto_refresh=False) as self.live:
+            renderer = threading.Thread(target=self.render_screen, name="renderer", daemon=True)
+            renderer.start()
+            try:
+                yield self.live
+            finally:
+                self.snapshot_put(False)
+                renderer.join()
+
+    def screen_update(self, updated):
+        """ hand a snapshot of the meter data to the renderer when the usage was updated, an older snapshot
+            not yet taken by the renderer is replaced, so the event loop never waits on the rendering """
+        if updated:
+            self.snapshot_put(ScreenSnapshot(self, self.panel_keys))
+
+    def snapshot_put(self, snapshot):
+        """ put the snapshot for the renderer, False stops the renderer """
+        with self.snapshot_ready:
+            self.snapshot = snapshot
+            self.snapshot_ready.notify()
+
+    def render_screen(self):
+        """ renderer thread: build the panels of the latest snapshot and render the screen,
+            at most fps times per second and only when a panel changed """
+        if not isinstance(fps := self.meter_info.get("fps", 1), (int, float)) or fps < 0.1:
+            pi.log_app.add(f"Renderer: fps={fps!r} not valid, 0.1 used", tpe="error")
+            fps = 0.1
+        frame_s = 1 / fps
+        while True:
+            with self.snapshot_ready:
+                self.snapshot_ready.wait_for(lambda: self.snapshot is not None)
+                snapshot, self.snapshot = self.snapshot, None
+            if snapshot is False:
+                return
+            start = time.monotonic()
+            try:
+                with pi.metrics.update_layout.time():
+                    dirty = snapshot.update_layout(self.layout)
+                if dirty:
+                    self.live.refresh()
+            except Exception as e:
+                pi.log_app.add(f"Renderer: {e!r}", tpe="error")
+            # wait for the next frame, but stop right away
+            with self.snapshot_ready:
+                self.snapshot_ready.wait_for(lambda: self.snapshot is False, frame_s - (time.monotonic() - start))
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+import array
+import bisect
+import datetime
+import math
+import os
+
+from ..app import pi
+
+from ..config import dir_series, series_columns, series_tiers
+
+from .batch_writer import BatchWriter
+
+
+class TimeSeries(BatchWriter):
+    """ this is a class to keep the readings of the meter every second, in fixed width records of float32
+        one file per tier and UTC day in dir_series, a record is the second of that day followed by the columns
+        the 1 minute and 15 minute tiers are the mean (or the last value of meter registers) of the seconds,
+        every tier has its own retention, see series_tiers, float32 keeps 7 digits, enough for a trend of the registers
+        query reads the records back in the disk_io thread, so after the writes """
+
+    def __init__(self, batch_s=60):
+        super().__init__(batch_s)
+        self.columns = list(series_columns)
+        self.last = [series_columns[c] == "last" for c in self.columns]
+        self.width = 1 + len(self.columns)  # floats per record
+        self.batch = dict((tier, array.array("f")) for tier in series_tiers)
+        self.buckets = {}  # tier -> [second of the bucket, seconds in it, sums, last values] of the open bucket
+        self.day = None    # UTC day of the records in the batch
+        os.makedirs(dir_series, exist_ok=True)
+
+    series_n = lambda self, day, tier: f"{dir_series}{day.isoformat()}_{tier}.f32"
+    day_start = lambda self, day: datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc).timestamp()
+
+    def add(self, meter):
+        """ add the readings of the meter at meter.cur_time, missing readings are nan """
+        ts = meter.cur_time.timestamp()
+        if (day := datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).date()) != self.day:
+            # rotate, the open buckets and the collected records belong to the previous day
+            for tier in list(self.buckets):
+                self.bucket_close(tier)
+            self.flush()
+            pi.disk_io.submit(self.clean, day)
+            self.day = day
+        second = ts - self.day_start(day)
+        values = []
+        for c in self.columns:
+            value = getattr(meter, c, math.nan)
+            value = value.get("value", math.nan) if isinstance(value, dict) else value
+            values.append(value if isinstance(value, (int, float)) else math.nan)
+        for tier, (step, _) in series_tiers.items():
+            if step == 1:
+                self.batch[tier].append(second)
+                self.batch[tier].extend(values)
+                continue
+            bucket = second // step * step
+            if tier in self.buckets and self.buckets[tier][0] != bucket:
+                self.bucket_close(tier)
+            if tier not in self.buckets:
+                self.buckets[tier] = [bucket, 0, [0.0] * len(values), values]
+            it = self.buckets[tier]
+            it[1] += 1
+            it[2] = [x + y for x, y in zip(it[2], values)]
+            it[3] = values
+        self.flush_due()
+
+    def bucket_close(self, tier):
+        """ add the record of the bucket of the tier, the mean or the last value of the seconds in it """
+        bucket, n, sums, last = self.buckets.pop(tier)
+        self.batch[tier].append(bucket)
+        self.batch[tier].extend(v if is_last else s / n for s, v, is_last in zip(sums, last, self.last))
+
+    def take(self):
+        # the open buckets are added when they are complete
+        taken = [(self.series_n(self.day, tier), batch) for tier, batch in self.batch.items() if batch]
+        self.batch = dict((tier, array.array("f")) for tier in series_tiers)
+        return taken
+
+    def write(self, file_n, batch):
+        # runs in the disk_io thread
+        with open(file_n, "ab") as f:
+            batch.tofile(f)
+
+    def clean(self, today):
+        # runs in the disk_io thread, every tier keeps its own days
+        for tier, (_, keep_days) in series_tiers.items():
+            self.remove_days(lambda day: self.series_n(day, tier), today, keep_days, "Time series")
+
+    def query(self, start, end, tier="1s", columns=None):
+        """ return a future of the dict with "time" (epoch seconds) and the columns (array of float32) of the records
+            of the tier from start up to and including end (datetime), read in the disk_io thread
+            f.i. await asyncio.wrap_future(meter.series.query(start, end, "15m", ["kW_plus"])) """
+        pending = (self.day, array.array("f", self.batch[tier]))  # not handed to disk_io yet
+        return pi.disk_io.submit(self.read, start.timestamp(), end.timestamp(), tier, columns or self.columns, pending)
+
+    def read(self, start, end, tier, columns, pending):
+        # runs in the disk_io thread
+        width, found = self.width, {"time": array.array("d")} | dict((c, array.array("f")) for c in columns)
+        day = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).date()
+        while (day_start := self.day_start(day)) <= end:
+            records = array.array("f")
+            if os.path.exists(file_n := self.series_n(day, tier)):
+                with open(file_n, "rb") as f:
+                    data = f.read()
+                records.frombytes(data[:len(data) // (4 * width) * 4 * width])
+            if day == pending[0]:
+                records.extend(pending[1])
+            seconds = records[0::width]
+            lo, hi = bisect.bisect_left(seconds, start - day_start), bisect.bisect_right(seconds, end - day_start)
+            found["time"].extend(day_start + x for x in seconds[lo:hi])
+            for c in columns:
+                pos = 1 + self.columns.index(c)
+                found[c].extend(records[lo*width+pos:hi*width:width])
+            day += datetime.timedelta(days=1)
+        return found
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+from ..app import pi
+
+
+class Telegram:
+    """ a complete P1 telegram, the raw bytes are kept once in a slot of the TelegramBuffer
+        the lines are offsets in those bytes and are handed out as memoryview slices """
+
+    def __init__(self, view, lines, crc):
+        self.view = view    # memoryview from the / up to and including the \r\n of the ! + CRC16 checksum line
+        self.lines = lines  # (start, end) of each line, without the \r\n
+        self.crc = crc      # CRC16 calculated while the bytes arrived
+        # the checksum given in the telegram, hex after the !, None if not readable
+        start, end = lines[-1]
+        try:
+            self.checksum = int(bytes(view[start+1:end]).strip(), 16)
+        except ValueError:
+            self.checksum = None
+
+    def __iter__(self):
+        # the lines of the telegram as memoryview slices, no copy of the bytes
+        return (self.view[start:end] for start, end in self.lines)
+
+    def __len__(self):
+        return len(self.view)
+
+    def __bytes__(self):
+        return self.view.tobytes()
+
+
+class TelegramBuffer:
+    """ assemble the telegrams from the received bytes in a ring of preallocated slots
+        every byte is copied once into a slot, the CRC16 is updated on memoryview slices of the slot
+        and a complete telegram is handed out as a Telegram on the slot, the slot is only reused after
+        the other slots went round, so the consumer must not hold more than slots-2 telegrams """
+
+    def __init__(self, crc, slots=8, slot_size=8192):
+        self.crc = crc  # crc template, each telegram starts with crc.new()
+        self.slots = [bytearray(slot_size) for _ in range(slots)]
+        self.views = [memoryview(slot) for slot in self.slots]
+        self.slot = 0       # slot of the telegram in the making
+        self.pos = 0        # end of the bytes in the slot
+        self.line = 0       # start of the line not yet complete
+        self.lines = []     # (start, end) of the complete lines
+        self.p1crc = None   # None while waiting for the / of the next telegram
+
+    def restart(self):
+        self.pos, self.line, self.lines, self.p1crc = 0, 0, [], self.crc.new()
+
+    def feed(self, data):
+        """ add the received bytes and return the list of telegrams completed by them """
+        done, mv, off = [], memoryview(data), 0
+        while off < len(data):
+            if self.p1crc is None:
+                # waiting for the beginning of a P1 telegram, cut off previous data
+                if (off := data.find(b"/", off)) < 0:
+                    break
+                self.restart()
+            buf, view = self.slots[self.slot], self.views[self.slot]
+            if not (n := min(len(data) - off, len(buf) - self.pos)):
+                # a telegram is about 1 KB, a full slot without ! line is garbage
+                pi.log_app.add(f"Telegram without end after {self.pos} bytes, dropped", tpe="error")
+                self.p1crc = None
+                off += 1
+                continue
+            buf[self.pos:self.pos+n] = mv[off:off+n]
+            piece, self.pos, off = self.pos, self.pos + n, off + n
+            # catch up with the newlines, a \r at the end of the previous piece is looked at again
+            while (eol := buf.find(b"\r\n", max(self.line, piece - 1), self.pos)) >= 0:
+                start, self.line = self.line, eol + 2
+                if self.lines and (slash := buf.find(b"/", start, eol)) >= 0:
+                    # a new telegram (/) started before the previous one ended, restart at the beginning of the slot
+                    tail = self.pos - slash
+                    buf[:tail] = buf[slash:self.pos]
+                    self.restart()
+                    self.pos, piece, eol, start = tail, max(piece - slash, 0), eol - slash, 0
+                    self.line = eol + 2
+                if buf[start] == 0x21:  # P1 telegram ends with ! + CRC16 checksum, the checksum covers up to the !
+                    self.p1crc.update(view[start:start+1])
+                    self.lines.append((start, eol))
+                    done.append(Telegram(view[:eol+2], self.lines, self.p1crc.crcValue))
+                    # the bytes after the telegram are for the next telegram in the next slot
+                    off -= self.pos - (eol + 2)
+                    self.slot = (self.slot + 1) % len(self.slots)
+                    self.p1crc = None
+                    break
+                self.p1crc.update(view[start:eol+2])
+                self.lines.append((start, eol))
+        return done
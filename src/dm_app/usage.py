@@ -2,13 +2,18 @@
 
 import datetime
 import json
+import operator
+import time
 from ..app import pi
-from ..config import usage_columns, usage_rows, day_peak_columns
+from ..config import usage_columns, usage_rows, day_peak_columns, register_modulus
 
 class Usage:
     def __init__(self, *args, **kwargs):
         self.producing = False
         self.prev_kW_min = 0.0
+        self.journaled = {}  # what was in self.data at the last record of the journal
+        self.json_saved = {}  # file_n -> time.monotonic() of the last json export
+        self.json_written = {}  # path -> json text of the last json export
         super().__init__(*args, **kwargs)
 
     # unfortunately namedtuples cannot be used in pickle, so for day_peak we have to use a list
@@ -20,36 +25,43 @@ class Usage:
             self._zero_cumul = [0 for _ in range(len(usage_rows))]
         return self._zero_cumul
 
+    def set_delta_terms(self):
+        """ decide once for every row of usage_rows from which row of the cumul its delta is taken and with which
+            factor (the rate for the € rows), and which rows are meter registers that roll over at register_modulus """
+        registers = ["+Day", "-Day", "+Night", "-Night"]
+        rates = {"+€ Day": ("+", "Day"), "-€ Day": ("-", "Day"), "+€ Night": ("+", "Night"), "-€ Night": ("-", "Night")}
+        self.delta_src, self.delta_factor = [], []
+        for x, r in enumerate(usage_rows):
+            if r in rates:
+                self.delta_src.append(registers.index(f"{rates[r][0]}{rates[r][1]}"))
+                self.delta_factor.append(self.e_rate[rates[r][0]][rates[r][1]])
+            else:
+                self.delta_src.append(x)
+                self.delta_factor.append(1)
+        self.delta_registers = [usage_rows.index(r) for r in registers]
+        self.usage_periods = [x for x in usage_columns if "Day-" not in x]  # the past days are not updated
+
     def get_delta_cumul(self, new_cumul, old_cumul):
         """ calculate the difference between 2 cumuls, but consider that the meter values can flip over,
-            f.e. when the meter goes from 9999 to 0, the difference is 1, not -9999"""
+            f.e. when the meter goes from 999999 to 0, the difference is 1, not -999999
+            the registers roll over at register_modulus, before it was 10**(digits of the old value), which took
+            a register of 5 digits going back (f.e. after a meter swap) as a roll over at 100000 """
+        diff = list(map(operator.sub, new_cumul, old_cumul))
         # the counter flipped over if new < old
-        get_diff_meter_flips = lambda old, new: 10**(len(str(abs(old)).partition(".")[0])) + new - old if abs(new) < abs(old) else new - old
-        delta_cumul = []
-        for x, r in enumerate(usage_rows):
-            match r:
-                case "+Day" | "-Day" | "+Night" | "-Night":
-                    delta_cumul.append(get_diff_meter_flips(old_cumul[x], new_cumul[x]))
-                case "+€ Day":
-                    delta_cumul.append(get_diff_meter_flips(old_cumul[0], new_cumul[0])*self.e_rate["+"]["Day"])
-                case "-€ Day":
-                    delta_cumul.append(get_diff_meter_flips(old_cumul[1], new_cumul[1])*self.e_rate["-"]["Day"])
-                case "+€ Night":
-                    delta_cumul.append(get_diff_meter_flips(old_cumul[2], new_cumul[2])*self.e_rate["+"]["Night"])
-                case "-€ Night":
-                    delta_cumul.append(get_diff_meter_flips(old_cumul[3], new_cumul[3])*self.e_rate["-"]["Night"])
-                case _:
-                    delta_cumul.append(new_cumul[x] - old_cumul[x])
-        return delta_cumul
+        for x in self.delta_registers:
+            if diff[x] < 0:
+                diff[x] += register_modulus
+        return list(map(operator.mul, map(diff.__getitem__, self.delta_src), self.delta_factor))
 
     def set_data(self):
         # make a default data structure, read actual from pickle if any, else start from this
+        now = datetime.datetime.now().astimezone()  # timezone aware as the timestamps of the meter
         self.data = {"meters": {"Electricity": {"+Day": 0, "-Day": 0, "+Night": 0, "-Night": 0, "unit": "kWh"},
-                                "Gas": {"value": 0, "time": datetime.datetime.now(), "unit": "m3"},
-                                "Water": {"value": 0, "time": datetime.datetime.now(), "unit": "m3"}},
+                                "Gas": {"value": 0, "time": now, "unit": "m3"},
+                                "Water": {"value": 0, "time": now, "unit": "m3"}},
                      "usage": dict((x, self.zero_cumul[:]) for x in usage_columns),
-                     "cur_time": datetime.datetime.now(),
-                     "start_time": datetime.datetime.now(),
+                     "cur_time": now,
+                     "start_time": now,
                      "day_peak": dict((x, Usage._day_peak_zero[:]) for x in day_peak_columns),
                                            #  peak value, time of peak
                      "quarter_peak": 0}
@@ -67,20 +79,44 @@ class Usage:
         self.usage = self.data["usage"]                # beware, self.usage is updated automatically
         self.day_peak = self.data["day_peak"]
         self.peak_forecast = self.data["quarter_peak"]
+        # the timestamps of the meter are timezone aware, a pickle of an older version has naive ones in local time
+        for x in ["cur_time", "start_time"]:
+            if self.data[x].tzinfo is None:
+                self.data[x] = self.data[x].astimezone()
+        for peak in self.day_peak.values():
+            if peak[1] and peak[1].tzinfo is None:
+                peak[1] = peak[1].astimezone()
         # pointers into rates_dct
         self.e_rate = self.rates_dct["Electricity"]
         self.g_rate = self.rates_dct["Gas"]["+"]
         self.w_rate = self.rates_dct["Water"]["+"]
+        self.set_delta_terms()
 
-    def json_it(self, dct):
-        """ dump the data in json format"""
+    def json_it(self, dct, indent=4):
+        """ dump the data in json format, compact without indent"""
         encode_JSON = lambda x: self.ts_str(x) if isinstance(x, datetime.datetime) else repr(x)
-        return json.dumps(dct, indent=4, sort_keys=True, default=encode_JSON)
+        return json.dumps(dct, indent=indent, sort_keys=True, default=encode_JSON,
+                          separators=None if indent else (",", ":"))
 
-    def json_file(self, dct, file_n):
-        """ dump the data in json format in history_dir/file_n"""
-        with open(f"{pi.log_app.prefix_history}{file_n}", "w") as f:
-            f.write(self.json_it(dct))
+    def json_file(self, dct, file_n, force=False):
+        """ dump the data in json format in history_dir/file_n, at most every meter_info json_s seconds unless forced
+            (end of day), not when nothing changed, the file is written by the disk_io thread"""
+        now = time.monotonic()
+        if not force and now - self.json_saved.get(file_n, -now) < self.meter_info.get("json_s", 60):
+            return
+        self.json_saved[file_n] = now
+        path, txt = f"{pi.log_app.prefix_history}{file_n}", self.json_it(dct, self.meter_info.get("json_indent", None))
+        if self.json_written.get(path, None) == txt:
+            return
+        self.json_written = {path: txt}
+        pi.disk_io.submit(self.json_write, path, txt)
+
+    def json_write(self, path, txt):
+        try:
+            with open(path, "w") as f:
+                f.write(txt)
+        except OSError as e:
+            pi.log_app.add(f"!! err_json_write {path} {e}", tpe="error")
 
     def update_quarter_peak(self):
         self.clock_todo = 15*60  # seconds in a quarter
@@ -102,12 +138,59 @@ class Usage:
                 # add nty new peak for the day
                 self.day_peak["Today"] = [self.peak_forecast, self.cur_time-datetime.timedelta(seconds=self.clock_done)]
                 pi.log_app.add(f"New Day Peak - {self.day_peak['Today']=}")
-                pi.pickle_app.var_save(self)
+                pi.pickle_app.var_save(self, force=True)
         # beware, when producing energy, the quarter_peak is ZERO
         self.peak_gap = self.month_peak['value']-self.peak_forecast
         self.peak_gap_style = "green" if self.peak_gap > 0 else "red"
         return True
 
+    def usage_add(self, delta_cumul):
+        """ add the difference between 2 measurements to the usage of the periods, the past days are not updated """
+        for period in self.usage_periods:
+            self.usage[period][:] = map(operator.add, self.usage[period], delta_cumul)
+
+    def journal_add(self):
+        """ add a record with the changes in self.data since the previous record to the journal,
+            the meters (cumul) that changed, gas, water and today's peak when changed and the quarter peaks """
+        last_cumul = self.journaled.get("cumul", [])
+        changes = {"cumul": dict((x, v) for x, v in enumerate(self.data["cumul"])
+                                 if x >= len(last_cumul) or v != last_cumul[x])}
+        for meter in ["Gas", "Water"]:
+            if self.meters[meter] is not self.journaled.get(meter, None):
+                changes[meter] = self.meters[meter]
+        if self.day_peak["Today"] != self.journaled.get("day_peak", None):
+            changes["day_peak"] = self.day_peak["Today"][:]
+        self.journaled = {"cumul": self.data["cumul"], "Gas": self.meters["Gas"], "Water": self.meters["Water"],
+                          "day_peak": self.day_peak["Today"][:]}
+        self.data["journal_seq"] = self.data.get("journal_seq", 0) + 1
+        cur_time = self.data["cur_time"]
+        pi.pickle_app.journal_add((self.data["journal_seq"], cur_time.timestamp(), cur_time.utcoffset().total_seconds(),
+                                   self.data["prev_quarter_peak"], self.data["quarter_peak"], changes))
+
+    def journal_apply(self, record):
+        """ apply a record of the journal to self.data as update_usage did, return False when the record is of
+            another day, the next telegram will do the change of day with the usage since the last applied record """
+        seq, ts, offset, prev_quarter_peak, quarter_peak, changes = record
+        cur_time = datetime.datetime.fromtimestamp(ts, datetime.timezone(datetime.timedelta(seconds=offset)))
+        if cur_time.date() != self.data["cur_time"].date():
+            return False
+        now_cumul = self.data.get("cumul", self.zero_cumul)[:]
+        for x, v in changes["cumul"].items():
+            now_cumul[x] = v
+        if "cumul" in self.data:
+            self.usage_add(self.get_delta_cumul(now_cumul, self.data["cumul"]))
+        for x, meter in enumerate(["+Day", "-Day", "+Night", "-Night"]):
+            self.e_meter[meter] = now_cumul[x]
+        for meter in ["Gas", "Water"]:
+            if meter in changes:
+                self.meters[meter] = changes[meter]
+        if "day_peak" in changes:
+            self.day_peak["Today"] = changes["day_peak"]
+        self.data["cur_time"], self.data["cumul"], self.data["journal_seq"] = cur_time, now_cumul, seq
+        self.data["prev_quarter_peak"], self.data["quarter_peak"] = prev_quarter_peak, quarter_peak
+        self.peak_forecast = quarter_peak
+        return True
+
     @property
     def sum_utilities(self):
         """ calculate the sum of all utilities at the spot to ensure it is always a correct sum when used"""
@@ -125,9 +208,11 @@ class Usage:
         def end_of(period):
             str_period = f"{', '.join(f'{u}={self.usage[period][x]:.2f}' for x, u in enumerate(usage_rows))}"
             pi.log_app.add(f"{period} Ended --> {self.sum_utilities[usage_columns.index(period)]} Σ € Utilities\n{str_period}")
+            if self.history:
+                self.history.add_period(period, self.prev_time, self.usage[period])
             self.usage[period] = self.zero_cumul[:]
         def end_of_day():
-            self.json_file(self.data, "data.json")
+            self.json_file(self.data, "data.json", force=True)
             # move the usage and day_peak one day back
             for old, prev in [("Day-3", "Day-2"), ("Day-2", "Day-1"), ("Day-1", "Today")]:
                 if prev in self.usage:
@@ -179,11 +264,7 @@ class Usage:
             self.prev_time = self.cur_time
             self.data["quarter_peak"] = 0
         # 5. add the difference between both measurements to the usage
-        for period in usage_columns:
-            if "Day-" in period:
-                continue  # these are not updated
-            for pos, val in enumerate(self.delta_cumul):
-                self.usage[period][pos] += val
+        self.usage_add(self.delta_cumul)
         # 6. update Σ € Utilities
         self.data["cur_time"] = self.cur_time
         self.data["cumul"] = self.now_cumul
@@ -196,7 +277,11 @@ class Usage:
         #     self.data["usage"]["Year"][9]=269.88+0.01+156.99
         self.data["prev_quarter_peak"], self.data["quarter_peak"] = self.data["quarter_peak"], self.quarter_peak
         self.sum_utilities
-        pi.pickle_app.var_save(self)
+        # journal the changes, the pickle file is saved on a new day right away, else at most every pickle_save_s seconds
+        # a replay is not journaled, it ends with a save of the pickle file
+        if not self.meter_info.get("replay"):
+            self.journal_add()
+        pi.pickle_app.var_save(self, force=self.prev_time.day != self.cur_time.day)
         # 7. make special notification when producing energy, but make a dead band of 1 kW to avoid flooding messages
         if self.producing and self.kW_plus > 0.5:
             self.producing = False
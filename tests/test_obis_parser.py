@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+""" the compiled parser gives the same results as the regex parser on the recorded telegrams """
+
+import glob
+import io
+import os
+import shutil
+
+import pytest
+from rich.console import Console
+
+from src.app import pi
+from src.app.logger import Logger
+from src.dm_app.bus_meter import BusMeter, crc16
+from src.dm_app.telegram import TelegramBuffer
+
+dir_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+telegram_files = sorted(glob.glob(os.path.join(dir_root, "telegrams", "*.p1")))
+
+
+@pytest.fixture(autouse=True)
+def quiet_log(tmp_path, monkeypatch):
+    # the logger makes the history directory in the working directory, the meter reads the rates from it
+    shutil.copy(os.path.join(dir_root, "rates.json"), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pi, "log_app", Logger(Console(file=io.StringIO()), Console(file=io.StringIO())), raising=False)
+
+
+def new_meter(parser):
+    # a bare meter, without capture, series or history
+    meter = BusMeter(None, {"parser": parser})
+    meter.set_data()
+    meter.set_pointers()
+    return meter
+
+
+def parse_with(parser, p1telegram):
+    meter = new_meter(parser)
+    table = [tuple(str(x) for x in row) for row in meter.parse_telegram(p1telegram)]
+    return table, meter.obis_dict
+
+
+@pytest.mark.parametrize("file_n", telegram_files, ids=os.path.basename)
+def test_parsers_agree(file_n):
+    with open(file_n, "rb") as f:
+        p1telegram = TelegramBuffer(crc16).feed(f.read())[0]
+    assert parse_with("compiled", p1telegram) == parse_with("regex", p1telegram)
+
+
+def test_compiled_parser_same_telegram_twice():
+    # the second time the lines come from the cache of the compiled parser
+    with open(telegram_files[0], "rb") as f:
+        p1telegram = TelegramBuffer(crc16).feed(f.read())[0]
+    meter = new_meter("compiled")
+    first = [tuple(str(x) for x in row) for row in meter.parse_telegram(p1telegram)], dict(meter.obis_dict)
+    second = [tuple(str(x) for x in row) for row in meter.parse_telegram(p1telegram)], meter.obis_dict
+    assert first == second
+    assert not meter.changed_obis
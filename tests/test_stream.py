@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+""" a subscriber gets the updates of its topics, and the count of the updates of its topics it lost """
+
+import asyncio
+import io
+import json
+
+from rich.console import Console
+
+from src.app.logger import Logger
+from src.app.stream import Stream
+
+
+class SlowSocket:
+    """ a websocket that takes a while to send every message """
+    closed = False
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_str(self, data):
+        await asyncio.sleep(0.01)
+        self.sent.append(json.loads(data))
+
+
+def test_dropped_of_own_topics(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the logger makes the history directory in the working directory
+
+    async def main():
+        stream = Stream(Logger(Console(file=io.StringIO()), Console(file=io.StringIO())), str, depth=4)
+        ws = SlowSocket()
+        topics = stream.subscribe(set(), ["peak"])
+        stream.subscribe(set(), ["phases"])  # another subscriber keeps phases published
+        sender = asyncio.create_task(stream.serve(ws, "test", topics))
+        await asyncio.sleep(0)
+        stream.publish("peak", lambda: 0)
+        await asyncio.sleep(0)  # the first update is taken, the subscriber is busy sending it
+        for x in range(1, 4):
+            stream.publish("peak", lambda: x)
+            for _ in range(10):
+                stream.publish("phases", lambda: x)
+        stream.publish("peak", lambda: 4)
+        await asyncio.sleep(0.1)
+        sender.cancel()
+        return ws.sent
+
+    sent = asyncio.run(main())
+    assert [x["type"] for x in sent] == ["peak", "dropped", "peak"]
+    assert sent[1]["count"] == 3
+    assert [sent[0]["data"], sent[2]["data"]] == [0, 4]
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+""" the framing of the telegrams by TelegramBuffer, whatever the chunks the bytes arrive in """
+
+import glob
+import io
+import os
+
+import pytest
+from rich.console import Console
+
+from src.app import pi
+from src.app.logger import Logger
+from src.dm_app.bus_meter import crc16
+from src.dm_app.telegram import TelegramBuffer
+
+dir_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixtures = dict((os.path.basename(x), open(x, "rb").read())
+                for x in sorted(glob.glob(os.path.join(dir_root, "telegrams", "*.p1"))))
+
+
+@pytest.fixture(autouse=True)
+def quiet_log(tmp_path, monkeypatch):
+    # the logger makes the history directory in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pi, "log_app", Logger(Console(file=io.StringIO()), Console(file=io.StringIO())), raising=False)
+
+
+def feed(buffer, chunks):
+    return [telegram for chunk in chunks for telegram in buffer.feed(chunk)]
+
+
+def check(telegram, raw):
+    assert bytes(telegram) == raw
+    assert telegram.checksum is not None and telegram.crc == telegram.checksum
+    assert [bytes(line) for line in telegram] == raw.split(b"\r\n")[:-1]
+
+
+@pytest.mark.parametrize("file_n", fixtures)
+def test_byte_by_byte(file_n):
+    # every \r\n is split over 2 chunks
+    raw = fixtures[file_n]
+    telegrams = feed(TelegramBuffer(crc16), [raw[x:x+1] for x in range(len(raw))])
+    assert len(telegrams) == 1
+    check(telegrams[0], raw)
+
+
+@pytest.mark.parametrize("file_n", fixtures)
+def test_garbage_and_truncated_telegram(file_n):
+    # the / of the full telegram restarts the framing of the truncated one
+    raw = fixtures[file_n]
+    telegrams = feed(TelegramBuffer(crc16), [b"\x00garbage\r\n" + raw[:len(raw) // 2], raw])
+    assert len(telegrams) == 1
+    check(telegrams[0], raw)
+
+
+def test_two_telegrams_in_one_chunk():
+    # the bytes after the first telegram are carried over to the next slot
+    raws = list(fixtures.values())[:2]
+    telegrams = TelegramBuffer(crc16).feed(b"".join(raws))
+    assert len(telegrams) == 2
+    for telegram, raw in zip(telegrams, raws):
+        check(telegram, raw)
+
+
+def test_telegrams_over_all_slots():
+    # more telegrams than slots, each in 2 chunks split in the middle of a line
+    buffer = TelegramBuffer(crc16, slots=3)
+    for raw in list(fixtures.values()) * 3:
+        telegrams = feed(buffer, [raw[:100], raw[100:]])
+        assert len(telegrams) == 1
+        check(telegrams[0], raw)
+
+
+def test_full_slot_without_end():
+    # a slot full without ! line is dropped, the next telegram is framed
+    raw = fixtures["single_phase.p1"]
+    buffer = TelegramBuffer(crc16, slot_size=1024)
+    assert buffer.feed(b"/" + b"x" * 2000) == []
+    telegrams = buffer.feed(raw)
+    assert len(telegrams) == 1
+    check(telegrams[0], raw)
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+""" the usage of the periods over a roll over of the registers, and the restore of the data from the pickle file and the journal after a crash """
+
+import datetime
+import io
+import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from rich.console import Console
+
+from src.app import pi
+from src.app.logger import Logger
+from src.app.metrics import Metrics
+from src.app.pickleit import PickleIt
+from src.config import usage_columns, usage_rows
+from src.dm_app.bus_meter import BusMeter, crc16
+from src.dm_app.telegram import TelegramBuffer
+
+dir_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def meter_env(tmp_path, monkeypatch):
+    # the pickle, journal and history files go to the working directory, the meter reads the rates from it
+    shutil.copy(os.path.join(dir_root, "rates.json"), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    disk_io = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(pi, "log_app", Logger(Console(file=io.StringIO()), Console(file=io.StringIO())), raising=False)
+    monkeypatch.setattr(pi, "disk_io", disk_io, raising=False)
+    monkeypatch.setattr(pi, "metrics", Metrics(), raising=False)
+    monkeypatch.setattr(pi, "pickle_app", PickleIt(pi.log_app, disk_io, pi.metrics), raising=False)
+    yield
+    disk_io.shutdown(wait=True)
+
+
+def new_meter():
+    meter = BusMeter(None, {"parser": "compiled"})
+    meter.set_data()
+    meter.set_pointers()
+    with open(os.path.join(dir_root, "telegrams", "three_phase.p1"), "rb") as f:
+        meter.parse_telegram(TelegramBuffer(crc16).feed(f.read())[0])
+    return meter
+
+
+def test_restore_after_crash():
+    # every telegram is journaled, the pickle file is only saved at the first one, the crash skips the final save
+    meter = new_meter()
+    for x in range(300):
+        meter.cur_time = meter.cur_time + datetime.timedelta(seconds=1)
+        meter.kwH_day_plus += 0.0005
+        meter.kwH_day_min += 0.0001 * (x % 3)
+        meter.update_usage()
+    pi.disk_io.submit(lambda: None).result()
+    restored = BusMeter(None, {"parser": "compiled"})
+    restored.set_data()
+    PickleIt(pi.log_app, pi.disk_io, pi.metrics).var_restore(restored)
+    assert restored.data["journal_seq"] == 300
+    assert restored.data == meter.data
+
+
+def test_replay_not_journaled():
+    meter = new_meter()
+    meter.meter_info["replay"] = "recorded.p1"
+    for x in range(3):
+        meter.cur_time = meter.cur_time + datetime.timedelta(seconds=1)
+        meter.update_usage()
+    pi.disk_io.submit(lambda: None).result()
+    assert "journal_seq" not in meter.data
+    assert not os.path.exists("data.journal") or os.path.getsize("data.journal") == 0
+
+
+def test_register_rollover():
+    # a register going from 999999.9 to 0.1 used 0.2 kWh, the € row is that times the rate
+    meter = new_meter()
+    old, new = meter.zero_cumul[:], meter.zero_cumul[:]
+    old[usage_rows.index("+Day")], new[usage_rows.index("+Day")] = 999999.9, 0.1
+    delta = meter.get_delta_cumul(new, old)
+    assert delta[usage_rows.index("+Day")] == pytest.approx(0.2)
+    assert delta[usage_rows.index("+€ Day")] == pytest.approx(0.2 * meter.e_rate["+"]["Day"])
+    assert delta[usage_rows.index("-Day")] == 0
+
+
+def test_update_usage_over_rollover():
+    # the past days keep their usage, the periods of today add the delta
+    meter = new_meter()
+    meter.kwH_day_plus = 999999.9
+    meter.update_usage()
+    before = dict((period, meter.usage[period][:]) for period in usage_columns)
+    meter.cur_time = meter.cur_time + datetime.timedelta(seconds=1)
+    meter.kwH_day_plus = 0.1
+    meter.update_usage()
+    for period in usage_columns:
+        added = [x - y for x, y in zip(meter.usage[period], before[period])]
+        if period.startswith("Day-"):
+            assert added == [0] * len(usage_rows)
+            continue
+        assert added[usage_rows.index("+Day")] == pytest.approx(0.2)
+        assert added[usage_rows.index("+€ Day")] == pytest.approx(0.2 * meter.e_rate["+"]["Day"])
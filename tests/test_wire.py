@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+""" a message decodes to what was encoded, with the same shape, in every wire format """
+
+import pytest
+
+from src.app.wire import Wire
+
+msg = {"type": "th", "cmd": "set", "th": "kW_plus", "val": 1.5}
+wire = Wire(["kW_plus", "gas_meter"], str)
+
+
+@pytest.mark.parametrize("fmt", wire.formats)
+@pytest.mark.parametrize("data", [msg, [msg], [msg, msg | {"th": "not_in_ths", "val": 2}], []])
+def test_same_shape(fmt, data):
+    assert wire.decode(wire.encode(data, fmt), fmt) == data
+
+
+@pytest.mark.parametrize("val", ["12", True, None])
+def test_struct_only_numbers(val):
+    # a val that is not a number goes out as json, unchanged
+    encoded = wire.encode(msg | {"val": val}, "struct")
+    assert isinstance(encoded, str)
+    assert wire.decode(encoded) == msg | {"val": val}